@@ -1,42 +1,322 @@
 import os
 import sys
+import enum
 import json
 import click
 import colored
 import sqlite3
 import dataset
-import hashlib
+import functools
+import threading
+import collections
+import urllib.parse
 
 from flask import current_app, g
 
+from . import hasher
+from . import digest_index
+from . import walker
+from . import metrics
+
+def db_pragmas():
+    ## WAL lets readers carry on while a batch commits and with synchronous=NORMAL
+    ##     only checkpoints fsync - a crash loses at most the last batch, never the DB
+    return [ 'PRAGMA journal_mode=WAL',
+             'PRAGMA synchronous=%s' % current_app.config.get('DB_SYNCHRONOUS', 'NORMAL') ]
+
 def get_db():
     if 'db' not in g:
         g.DATABASE_PATH = 'sqlite:///' + current_app.config['DATABASE']
 
+        ## DB_READ_ONLY: e.g. shard workers - only the coordinator writes (see shards.py)
+        read_only = current_app.config.get('DB_READ_ONLY', False)
+        database = current_app.config['DATABASE']
+        if read_only: database = 'file:%s?mode=ro' % (urllib.parse.quote(database))
+
         # https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/#sqlite3
         g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+            database, uri=read_only,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=256 ## Keeps every DAO statement prepared
         )
         g.db.row_factory = sqlite3.Row
+        if not read_only:
+            for pragma in db_pragmas(): g.db.execute(pragma)
+            g.db.execute('PRAGMA foreign_keys=ON') ## files.dir_id must be a real dir
+            migrate_schema(g.db)
 
     if 'ds' not in g:
-        g.ds = dataset.connect(g.DATABASE_PATH)
+        g.ds = dataset.connect(g.DATABASE_PATH, on_connect_statements=db_pragmas())
 
     return (g.db, g.ds)
 
+def get_hash_algo():
+    """ The digest new hashes use - see hasher.check_algorithm() """
+    return current_app.config.get('HASH_ALGORITHM', hasher.DEFAULT_ALGORITHM)
+
+## PRAGMA user_version n means MIGRATIONS[:n] have run - see migrate_schema()
+CATALOG = '''CREATE VIEW catalog AS
+    SELECT files.id, files.dir_id, rtrim(dirs.abs_path, '/') || '/' || files.name AS abs_path,
+           dirs.abs_path AS path, files.name, files.sha1, files.hash_algo, files.fingerprint,
+           files.status, files.size
+    FROM files JOIN dirs ON dirs.id = files.dir_id'''
+
+def _columns_or_null(have, columns):
+    ## Old tables may predate a column - copy NULLs for it
+    return ', '.join( c if c in have else 'NULL' for c in columns )
+
+def _v1_hash_algo(db):
+    ## Rows from before HASH_ALGORITHM are all sha1 - say so, so matching can filter on it
+    columns = [ row[1] for row in db.execute('PRAGMA table_info(files)') ]
+    if columns and 'hash_algo' not in columns:
+        db.execute('ALTER TABLE files ADD COLUMN hash_algo TEXT')
+        db.execute('UPDATE files SET hash_algo = ? WHERE sha1 IS NOT NULL',
+                   (hasher.DEFAULT_ALGORITHM, ))
+    return False
+
+def _v2_dir_ids(db):
+    ## Every dir's path stored once - files point at it by id and are unique per (dir, name)
+    legacy = { }
+    for table in ('files', 'dirs'):
+        columns = [ row[1] for row in db.execute('PRAGMA table_info(%s)' % (table)) ]
+        if not columns: continue
+        db.execute('ALTER TABLE %s RENAME TO %s_v1' % (table, table))
+        legacy[table] = columns
+
+    db.execute('CREATE TABLE dirs ('
+               ' id INTEGER PRIMARY KEY, abs_path TEXT NOT NULL UNIQUE,'
+               ' mtime_ns BIGINT, n_files BIGINT, n_dirs BIGINT )')
+    db.execute('CREATE TABLE files ('
+               ' id INTEGER PRIMARY KEY, dir_id INTEGER NOT NULL REFERENCES dirs (id),'
+               ' name TEXT NOT NULL, sha1 TEXT, hash_algo TEXT, fingerprint TEXT,'
+               ' status TEXT, size BIGINT )')
+    db.execute('CREATE UNIQUE INDEX files_dir_name ON files (dir_id, name)')
+    db.execute('CREATE INDEX files_sha1 ON files (sha1, hash_algo)')
+    db.execute('CREATE INDEX files_size ON files (size)')
+    db.execute('CREATE INDEX files_name ON files (name)')
+    db.execute(CATALOG)
+
+    if 'dirs' in legacy: ## Only scanned dirs had rows - the newest one for a path wins
+        db.execute('INSERT INTO dirs (abs_path, mtime_ns, n_files, n_dirs) SELECT abs_path, %s'
+                   ' FROM dirs_v1 WHERE id IN (SELECT MAX(id) FROM dirs_v1 GROUP BY abs_path)'
+                   ' ORDER BY id' % _columns_or_null(legacy['dirs'],
+                                                     ('mtime_ns', 'n_files', 'n_dirs')) )
+        db.execute('DROP TABLE dirs_v1')
+
+    if 'files' in legacy: ## Same for files - REPLACE in id order leaves the newest
+        db.execute('INSERT OR IGNORE INTO dirs (abs_path) SELECT DISTINCT path FROM files_v1')
+        db.execute('INSERT OR REPLACE INTO files'
+                   ' (dir_id, name, sha1, hash_algo, fingerprint, status, size)'
+                   ' SELECT dirs.id, files_v1.name, %s FROM files_v1'
+                   ' JOIN dirs ON dirs.abs_path = files_v1.path ORDER BY files_v1.id'
+                   % _columns_or_null(legacy['files'], ('sha1', 'hash_algo', 'fingerprint',
+                                                        'status', 'size')) )
+        db.execute('DROP TABLE files_v1')
+
+    return bool(legacy) ## The old tables' pages are free now - worth a VACUUM
+
+def _v3_meta(db):
+    ## files_generation changes with every files write - digest_index.py stamps its sidecar
+    ##     with it. Starts random so a new DB never matches an old sidecar.
+    db.execute('CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value )')
+    db.execute("INSERT INTO meta (key, value) VALUES ('files_generation', abs(random() >> 2))"
+               " ON CONFLICT (key) DO UPDATE SET value = excluded.value")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        db.execute("CREATE TRIGGER IF NOT EXISTS files_generation_%s AFTER %s ON files"
+                   " BEGIN UPDATE meta SET value = value + 1"
+                   " WHERE key = 'files_generation'; END" % (event.lower(), event))
+    return False
+
+MIGRATIONS = [ _v1_hash_algo, _v2_dir_ids, _v3_meta ]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate_schema(db):
+    """ Run whatever MIGRATIONS the DB hasn't had yet - one transaction per step """
+    vacuum = False
+    while db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        db.execute('BEGIN IMMEDIATE') ## Another process may be migrating too - wait for it
+        try:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                vacuum = MIGRATIONS[version](db) or vacuum
+                db.execute('PRAGMA user_version = %d' % (version + 1))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+    if vacuum: db.execute('VACUUM')
+
+## Every column the DAO may name - table / column names never come from data
+SCHEMA = {
+    'dirs':    ('id', 'abs_path', 'mtime_ns', 'n_files', 'n_dirs'),
+    'files':   ('id', 'dir_id', 'name', 'sha1', 'hash_algo', 'fingerprint', 'status', 'size'),
+    'catalog': ('id', 'dir_id', 'abs_path', 'path', 'name', 'sha1', 'hash_algo', 'fingerprint',
+                'status', 'size'),
+}
+## What upsert() conflicts on - and what tells db_add() rows apart in a BulkWriter
+UNIQUE = { 'dirs': ('abs_path', ), 'files': ('dir_id', 'name') }
+ROW_KEYS = { 'dirs': ('abs_path', ), 'files': ('path', 'name') }
+
+class DAO():
+    """ Parameterized statements on get_db()'s sqlite3 connection - for the hot paths
+
+        Each statement string is built once per (kind, table, columns) so sqlite3's
+            statement cache keeps it prepared - a lookup or upsert costs microseconds
+            instead of dataset's reflection and query building. dataset is still there
+            (get_db()) for ad-hoc listing.
+
+        Read files through the `catalog` view - an abs_path there is looked up as
+            (path, name) so it's two index seeks. Rows written to `files` carry `path`
+            and we swap it for the dir's id (see dir_id()).
+    """
+    def __init__(self, db):
+        self.db = db
+        self.statements = { }
+        self.dir_ids = { } ## { abs_path: dirs.id } - dirs are never renumbered
+
+    def _statement(self, kind, table, columns):
+        key = (kind, table, columns)
+        if key in self.statements: return self.statements[key]
+
+        for column in columns:
+            if column not in SCHEMA[table]: raise ValueError('No column %s.%s' % (table, column))
+
+        where = ' AND '.join( '%s = ?' % (c) for c in columns )
+        if kind == 'select':
+            sql = 'SELECT * FROM %s WHERE %s' % (table, where)
+        elif kind == 'delete':
+            sql = 'DELETE FROM %s WHERE %s' % (table, where)
+        elif kind == 'upsert':
+            keys = UNIQUE[table]
+            update = ', '.join( '%s = excluded.%s' % (c, c) for c in columns if c not in keys )
+            sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO %s' % (table,
+                        ', '.join(columns), ', '.join( '?' for c in columns ), ', '.join(keys),
+                        'UPDATE SET ' + update if update else 'NOTHING')
+
+        self.statements[key] = sql
+        return sql
+
+    def _where(self, table, where):
+        ## (columns, values) - None if an abs_path's dir isn't even known (so no rows)
+        where = dict(where)
+        if 'abs_path' in where and table in ('catalog', 'files'):
+            where['path'], where['name'] = os.path.split(where.pop('abs_path'))
+        if 'path' in where and table == 'files':
+            where['dir_id'] = self.dir_id(where.pop('path'), create=False)
+            if where['dir_id'] is None: return None, None
+
+        columns = tuple(sorted(where))
+        return columns, [ where[c] for c in columns ]
+
+    def dir_id(self, abs_path, create = True):
+        """ dirs.id for abs_path - INSERTed the first time we see it unless create is False """
+        if abs_path in self.dir_ids: return self.dir_ids[abs_path]
+
+        row = self.db.execute('SELECT id FROM dirs WHERE abs_path = ?', (abs_path, )).fetchone()
+        if row:
+            self.dir_ids[abs_path] = row[0]
+        elif create:
+            self.dir_ids[abs_path] = self.db.execute('INSERT INTO dirs (abs_path) VALUES (?)',
+                                                     (abs_path, )).lastrowid
+        return self.dir_ids.get(abs_path)
+
+    def lookup(self, table, **where):
+        """ First row matching where (column=value ...) as a dict - None if there isn't one """
+        columns, values = self._where(table, where)
+        if columns is None: return None
+
+        row = self.db.execute(self._statement('select', table, columns) + ' LIMIT 1',
+                              values).fetchone()
+        return dict(row) if row else None
+
+    def lookup_all(self, table, **where):
+        """ Every row matching where as a dict """
+        columns, values = self._where(table, where)
+        if columns is None: return [ ]
+
+        return [ dict(row) for row in self.db.execute(self._statement('select', table, columns),
+                                                      values) ]
+
+    def upsert(self, table, row):
+        """ INSERT row or UPDATE the one with the same UNIQUE key - the caller commits """
+        row = dict(row)
+        if 'path' in row and table == 'files': row['dir_id'] = self.dir_id(row.pop('path'))
+
+        columns = tuple(row)
+        self.db.execute(self._statement('upsert', table, columns), [ row[c] for c in columns ])
+
+    def upsert_many(self, table, rows):
+        """ upsert() every row in one transaction - all or nothing """
+        try:
+            with self.db:
+                for row in rows: self.upsert(table, row)
+        except:
+            self.dir_ids.clear() ## Some may have been INSERTed by the rolled back batch
+            raise
+
+    def delete(self, table, **where):
+        """ DELETE the rows matching where - returns how many went """
+        columns, values = self._where(table, where)
+        if columns is None: return 0
+
+        with self.db:
+            return self.db.execute(self._statement('delete', table, columns), values).rowcount
+
+    def delete_dir(self, abs_path):
+        """ DELETE a dir's row - unless files still point at it. Returns how many went """
+        self.dir_ids.pop(abs_path, None)
+        with self.db:
+            return self.db.execute('DELETE FROM dirs WHERE abs_path = ? AND NOT EXISTS'
+                                   ' (SELECT 1 FROM files WHERE files.dir_id = dirs.id)',
+                                   (abs_path, )).rowcount
+
+def get_dao():
+    if 'dao' not in g:
+        db, ds = get_db()
+        g.dao = DAO(db)
+    return g.dao
+
+def get_writer(table_name):
+    """ Return the BulkWriter for table_name - flushed for us in close_db() """
+    if 'writers' not in g:
+        g.writers = { }
+
+    if table_name not in g.writers:
+        g.writers[table_name] = BulkWriter(get_dao(), table_name, ROW_KEYS[table_name],
+                                           batch_size=current_app.config['DB_BATCH_SIZE'])
+    return g.writers[table_name]
+
 def init_db():
+    """ Drop the files and dirs tables and build them again at SCHEMA_VERSION """
+    flush_writers()
     db, ds = get_db()
-    table = ds['files']
-    table = ds['dirs']
 
-    files.create_index(['abs_path', 'name', 'sha1'])
-    dirs.create_index(['path', 'name'])
+    db.execute('DROP VIEW IF EXISTS catalog')
+    db.execute('DROP TABLE IF EXISTS files')
+    db.execute('DROP TABLE IF EXISTS dirs')
+    db.execute('PRAGMA user_version = 0')
+    db.commit()
+    migrate_schema(db)
+
+    g.pop('dao', None) ## All hold what was in the old tables
+    g.pop('file_index', None)
+    g.pop('digest_index', None)
+
+def flush_writers():
+    for writer in g.get('writers', { }).values(): writer.flush()
 
 def close_db(e=None):
+    ## Flush first - even on errors - so everything buffered before a crash lands
+    flush_writers()
+    g.pop('writers', None)
+
+    g.pop('dao', None)
     ds = g.pop('ds', None)
     db = g.pop('db', None)
 
+    for cache in _HASH_CACHES.values(): cache.flush()
+
     if db is not None:
         db.close()
 
@@ -51,34 +331,618 @@ def drop_db():
         os.remove( DATABASE_PATH )
     except:
         pass
+    try: ## Its digest index (see get_digest_index()) goes with it
+        os.remove( digest_index_path() )
+    except:
+        pass
     try: ## Separate try block in case dir exists but not db file
         os.rmdir( os.path.dirname(DATABASE_PATH) )
     except:
         pass
 
+class BulkWriter():
+    """ Buffer rows and upsert them - batch_size rows per transaction
+
+        Rows are keyed on `keys` (see ROW_KEYS) in the buffer so the last add() for a
+        path wins, exactly like doing the upserts one at a time.
+    """
+    def __init__(self, dao, table_name, keys = ('abs_path', ), batch_size = 1000):
+        self.dao = dao
+        self.table_name = table_name
+        self.keys = keys
+        self.batch_size = batch_size
+        self.rows = { }
+
+    def add(self, entry):
+        self.rows[ tuple(entry[k] for k in self.keys) ] = entry
+        if len(self.rows) >= self.batch_size: self.flush()
+
+    @metrics.timed('db_write')
+    def flush(self):
+        if not self.rows: return
+        rows, self.rows = list(self.rows.values()), { }
+        metrics.current().count('rows_written', len(rows))
+
+        try:
+            self.dao.upsert_many(self.table_name, rows)
+            return
+        except:
+            pass ## upsert_many() already rolled the batch back
+
+        ## Something in the batch is bad - go row by row so we only lose that one
+        for entry in rows:
+            try:
+                self.dao.upsert_many(self.table_name, [ entry ])
+            except:
+                click.echo( "Error trying to ADD %s: %s" % (self.table_name,
+                                os.path.join(*( entry[k] for k in self.keys ))) )
+
+class HashCache():
+    """ Digests keyed by stat (st_dev, st_ino, size, mtime_ns) so renames don't re-read
+
+        One row per inode and algorithm - a file changing size or mtime simply replaces
+            its row. get() / put() default to `algo` (see get_hash_algo())
+        `verified` rows hold a digest we read from the file ourselves. Ones taken on trust
+            (the catalog, another machine's merge()) are kept for reuse but get(...,
+            verified=True) won't return them - anything about to delete a file asks that.
+        A row may carry the file's head / tail fingerprint too - kept until its stat changes.
+    """
+    def __init__(self, path, batch_size = 1000, pragmas = [ ], algo = hasher.DEFAULT_ALGORITHM):
+        self.path = path
+        self.algo = algo
+        self.lock = threading.Lock() ## Flask may call us from several request threads
+        self.pending = 0
+        self.batch_size = batch_size
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        for pragma in pragmas: self.db.execute(pragma)
+        self.db.execute('CREATE TABLE IF NOT EXISTS hash_cache ('
+                        ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+                        ' sha1 TEXT, abs_path TEXT, path TEXT, algo TEXT, verified INTEGER,'
+                        ' fingerprint TEXT, PRIMARY KEY (dev, ino, algo) )')
+
+        ## Caches from before incremental scans have no `path` (dir) column
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(hash_cache)') ]
+        if 'path' not in columns:
+            self.db.execute('ALTER TABLE hash_cache ADD COLUMN path TEXT')
+            rows = self.db.execute('SELECT dev, ino, abs_path FROM hash_cache').fetchall()
+            self.db.executemany('UPDATE hash_cache SET path = ? WHERE dev = ? AND ino = ?',
+                                [ (os.path.dirname(p), dev, ino) for dev, ino, p in rows ])
+
+        ## ... nor an `algo` - it's part of the primary key so copy into a new table
+        if 'algo' not in columns:
+            self.db.execute('ALTER TABLE hash_cache RENAME TO hash_cache_sha1')
+            self.db.execute('CREATE TABLE hash_cache ('
+                            ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+                            ' sha1 TEXT, abs_path TEXT, path TEXT, algo TEXT,'
+                            ' PRIMARY KEY (dev, ino, algo) )')
+            self.db.execute('INSERT INTO hash_cache SELECT dev, ino, size, mtime_ns, sha1,'
+                            ' abs_path, path, ? FROM hash_cache_sha1',
+                            (hasher.DEFAULT_ALGORITHM, ))
+            self.db.execute('DROP TABLE hash_cache_sha1')
+
+        ## ... nor `verified` - rows from then may have come from the catalog, so they didn't
+        if 'verified' not in columns:
+            self.db.execute('ALTER TABLE hash_cache ADD COLUMN verified INTEGER DEFAULT 0')
+        if 'fingerprint' not in columns:
+            self.db.execute('ALTER TABLE hash_cache ADD COLUMN fingerprint TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hash_cache_path ON hash_cache (path)')
+        self.db.commit()
+
+    def _lookup(self, st, algo, verified = False):
+        ## (sha1, abs_path, verified) - callers hold the lock
+        row = self.db.execute('SELECT sha1, abs_path, verified FROM hash_cache WHERE dev = ?'
+                              ' AND ino = ? AND algo = ? AND size = ? AND mtime_ns = ?',
+                              (st.st_dev, st.st_ino, algo or self.algo,
+                               st.st_size, st.st_mtime_ns)).fetchone()
+        if row and verified and not row[2]: row = None ## Only taken on trust
+        metrics.current().count('hash_cache_hits' if row else 'hash_cache_misses')
+        return row
+
+    def get(self, st, abs_path = None, algo = None, verified = False):
+        with self.lock:
+            row = self._lookup(st, algo, verified)
+            if not row: return None
+
+            if abs_path and abs_path != row[1]: ## Renamed / moved - keep evict() honest
+                self.db.execute('UPDATE hash_cache SET abs_path = ?, path = ?'
+                                ' WHERE dev = ? AND ino = ?',
+                                (abs_path, os.path.dirname(abs_path), st.st_dev, st.st_ino))
+                self._written()
+            return row[0]
+
+    def put(self, st, abs_path, sha1, algo = None, verified = True):
+        """ verified: sha1 is what we just read from the file - not the catalog's word """
+        with self.lock:
+            ## The fingerprint survives only if the file hasn't changed since it was taken
+            self.db.execute('INSERT INTO hash_cache'
+                            ' (dev, ino, size, mtime_ns, sha1, abs_path, path, algo, verified)'
+                            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                            ' ON CONFLICT (dev, ino, algo) DO UPDATE SET'
+                            ' fingerprint = CASE WHEN size = excluded.size AND'
+                            ' mtime_ns = excluded.mtime_ns THEN fingerprint END,'
+                            ' size = excluded.size, mtime_ns = excluded.mtime_ns,'
+                            ' sha1 = excluded.sha1, abs_path = excluded.abs_path,'
+                            ' path = excluded.path, verified = excluded.verified',
+                            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sha1,
+                             abs_path, os.path.dirname(abs_path), algo or self.algo,
+                             int(verified)))
+            self._written()
+
+    def fingerprint(self, st):
+        """ The fingerprint kept for this stat - None if it changed or we never took one """
+        with self.lock:
+            row = self.db.execute('SELECT fingerprint FROM hash_cache WHERE dev = ? AND'
+                                  ' ino = ? AND size = ? AND mtime_ns = ? AND'
+                                  ' fingerprint IS NOT NULL LIMIT 1',
+                                  (st.st_dev, st.st_ino, st.st_size,
+                                   st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, st, fingerprint):
+        """ Keep fingerprint with the digests we have for this stat - a no-op without one """
+        with self.lock:
+            self.db.execute('UPDATE hash_cache SET fingerprint = ? WHERE dev = ? AND ino = ?'
+                            ' AND size = ? AND mtime_ns = ?',
+                            (fingerprint, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+            self._written()
+
+    def entries_in(self, dir_name):
+        """ Every cached file in dir_name as walker.CachedEntry - for incremental scans """
+        with self.lock:
+            rows = self.db.execute('SELECT dev, ino, size, mtime_ns, sha1, abs_path,'
+                                   ' fingerprint FROM hash_cache WHERE path = ? AND algo = ?',
+                                   (dir_name, self.algo)).fetchall()
+
+        return [ walker.CachedEntry(r[5], walker.CachedStat(*r[:4]), r[4], r[6])
+                    for r in rows ]
+
+    def sync_dir(self, dir_name, abs_paths):
+        """ Forget cached files of dir_name that aren't in abs_paths (deleted / renamed) """
+        keep = set(abs_paths)
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT dev, ino, abs_path FROM hash_cache'
+                                   ' WHERE path = ?', (dir_name, )).fetchall()
+
+            stale = [ (dev, ino) for dev, ino, abs_path in rows if abs_path not in keep ]
+            if stale:
+                self.db.executemany('DELETE FROM hash_cache WHERE dev = ? AND ino = ?', stale)
+                self._written()
+
+    def dump(self):
+        """ Yield (abs_path, size, mtime_ns, sha1, algo) for every row - sorted, no dev / ino
+
+            Reads on a connection of its own so get() / put() aren't locked out meanwhile
+        """
+        self.flush()
+        db = sqlite3.connect(self.path)
+        try:
+            yield from db.execute('SELECT abs_path, size, mtime_ns, sha1, algo FROM hash_cache'
+                                  ' ORDER BY abs_path, algo')
+        finally:
+            db.close()
+
+    def merge(self, rows):
+        """ Add (abs_path, size, mtime_ns, sha1, algo) rows from another machine's dump()
+
+            Each is keyed by stat()ing abs_path here and only kept if the file has the
+                same size and mtime_ns - rows we already have for that inode win.
+                They're never `verified` - we haven't read the files ourselves.
+            Returns how many were added
+        """
+        keep = [ ]
+        for abs_path, size, mtime_ns, sha1, algo in rows:
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns): continue
+            keep.append( (st.st_dev, st.st_ino, size, mtime_ns, sha1, abs_path,
+                          os.path.dirname(abs_path), algo) )
+
+        with self.lock:
+            changes = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO hash_cache'
+                                ' (dev, ino, size, mtime_ns, sha1, abs_path, path, algo,'
+                                ' verified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)', keep)
+            self.db.commit()
+            return self.db.total_changes - changes
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.db.commit()
+            self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def evict(self):
+        """ Drop rows whose inode is gone (or replaced) - returns the number dropped """
+        stale = [ ]
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT dev, ino, abs_path FROM hash_cache').fetchall()
+
+        for dev, ino, abs_path in rows:
+            try:
+                st = os.stat(abs_path)
+                if (st.st_dev, st.st_ino) == (dev, ino): continue
+            except OSError:
+                pass
+            stale.append( (dev, ino) )
+
+        with self.lock:
+            self.db.executemany('DELETE FROM hash_cache WHERE dev = ? AND ino = ?', stale)
+            self.db.commit()
+        return len(stale)
+
+_HASH_CACHES = { } ## { (pid, path, algo): HashCache } - one connection per process
+
+def get_hash_cache():
+    key = ( os.getpid(), current_app.config['HASH_CACHE'], get_hash_algo() )
+
+    if key not in _HASH_CACHES:
+        _HASH_CACHES[key] = HashCache( current_app.config['HASH_CACHE'],
+                                       current_app.config['DB_BATCH_SIZE'], db_pragmas(),
+                                       get_hash_algo() )
+    return _HASH_CACHES[key]
+
+def forget_hash_caches(prefix):
+    """ Close and drop every HashCache kept for a path under prefix - e.g. a temp dir """
+    for key in [ k for k in _HASH_CACHES if k[1].startswith(prefix) ]:
+        cache = _HASH_CACHES.pop(key)
+        cache.flush()
+        cache.db.close()
+
+class DirIndex():
+    """ What we know about each dir from the last scan - feeds walker.walk()
+
+        record() stores a dir's mtime and child counts in the dirs table as we go.
+        reuse() says a dir is unchanged if its mtime and counts still match and we have
+        every one of its files in the HashCache - then we skip its scandir() entirely.
+
+        NOTE: a dir's mtime only changes when entries are added / removed / renamed
+            so a file rewritten in place keeps its old hash until the dir changes
+    """
+    def __init__(self, load = False):
+        self.dirs = { }
+        self.children = collections.defaultdict(list)
+        if not load: return
+
+        db, ds = get_db()
+        metrics.current().count('db_queries')
+        try:
+            ## Dirs only there because a file is in them (no mtime) were never scanned
+            rows = db.execute('SELECT abs_path, mtime_ns, n_files, n_dirs FROM dirs'
+                              ' WHERE mtime_ns IS NOT NULL')
+            for row in rows:
+                self.dirs[row['abs_path']] = row
+                self.children[os.path.split(row['abs_path'])[0]].append(row['abs_path'])
+        except sqlite3.OperationalError: ## Never scanned with dirs recorded before
+            pass
+
+    def record(self, dir_name, st, files, subs):
+        dNode = DirNode(dir_name)
+        dNode.set_scan(st, len(files), len(subs))
+        dNode.db_add()
+
+        self.forget_gone(dir_name, subs)
+        get_hash_cache().sync_dir(dir_name, files)
+
+    def forget_gone(self, dir_name, subs):
+        """ Drop what we knew about scanned dirs under dir_name that aren't in subs any more
+
+            Else reuse() would count them as children of dir_name forever. Their rows
+                stay (files may still point at them) with the scan columns set to NULL.
+        """
+        db, ds = get_db()
+        prefix = os.path.join(dir_name, '')
+        keep = set(subs)
+
+        ## Everything under dir_name - `/` + 1 is `0` so the range is exactly the subtree
+        metrics.current().count('db_queries')
+        rows = db.execute('SELECT abs_path FROM dirs WHERE abs_path > ? AND abs_path < ?'
+                          ' AND mtime_ns IS NOT NULL',
+                          (prefix, prefix[:-1] + chr(ord(os.sep) + 1))).fetchall()
+
+        for (abs_path, ) in rows:
+            child = os.path.join(dir_name, abs_path[len(prefix):].split(os.sep)[0])
+            if child in keep: continue
+
+            DirNode(abs_path).db_add() ## No set_scan() - NULLs
+            self.dirs.pop(abs_path, None)
+            siblings = self.children.get(os.path.split(abs_path)[0])
+            if siblings and abs_path in siblings: siblings.remove(abs_path)
+
+    def reuse(self, dir_name, st):
+        row = self.dirs.get(dir_name)
+        if not row or row['mtime_ns'] != st.st_mtime_ns: return None
+
+        subs = self.children.get(dir_name, [ ])
+        if len(subs) != row['n_dirs']: return None
+
+        files = get_hash_cache().entries_in(dir_name)
+        if len(files) != row['n_files']: return None ## e.g. some were never hashed
+
+        metrics.current().count('dirs_reused')
+        return files, subs
+
+MAX_GROUPS_PAGE = 1000 ## Most groups one duplicate_groups() page will hold
+
+def duplicate_groups(cursor = None, limit = 50):
+    """ One page of digests held by more than one file - most wasted bytes first
+
+        Only rows digested with the same algorithm are grouped together. limit is held to
+        1 .. MAX_GROUPS_PAGE and a cursor we didn't hand out raises ValueError.
+        Returns (groups, next_cursor) where each group is a dict of sha1, hash_algo, count, size,
+        wasted (bytes we'd get back keeping one copy) and files [ {abs_path, status} ].
+        Pass next_cursor back in for the following page - None means we're done.
+    """
+    db, ds = get_db()
+    limit = min(max(limit, 1), MAX_GROUPS_PAGE)
+
+    after_wasted, after_sha1 = None, ''
+    if cursor: ## "<wasted>:<sha1>" of the last group on the previous page
+        after_wasted, after_sha1 = cursor.split(':', 1)
+        after_wasted = int(after_wasted)
+
+    ## One statement - the groups for this page joined back to their files
+    statement = '''
+        WITH groups AS (
+            SELECT hash_algo, sha1, COUNT(*) AS n, MAX(size) AS size,
+                   (COUNT(*) - 1) * MAX(size) AS wasted
+            FROM files WHERE sha1 IS NOT NULL GROUP BY hash_algo, sha1 HAVING COUNT(*) > 1 ),
+        page AS (
+            SELECT * FROM groups
+            WHERE :wasted IS NULL OR wasted < :wasted OR (wasted = :wasted AND sha1 > :sha1)
+            ORDER BY wasted DESC, sha1 LIMIT :limit )
+        SELECT page.hash_algo, page.sha1, page.n, page.size, page.wasted,
+               files.abs_path, files.status
+        FROM page JOIN catalog AS files
+            ON files.sha1 = page.sha1 AND files.hash_algo IS page.hash_algo
+        ORDER BY page.wasted DESC, page.sha1, page.hash_algo, files.abs_path'''
+
+    metrics.current().count('db_queries')
+    try:
+        rows = db.execute(statement, { 'wasted': after_wasted, 'sha1': after_sha1,
+                                       'limit': limit }).fetchall()
+    except sqlite3.OperationalError: ## No files table yet
+        return [ ], None
+
+    groups = [ ]
+    for hash_algo, sha1, n, size, wasted, abs_path, status in rows:
+        if not groups or (groups[-1]['hash_algo'], groups[-1]['sha1']) != (hash_algo, sha1):
+            groups.append({ 'sha1': sha1, 'hash_algo': hash_algo, 'count': n, 'size': size,
+                            'wasted': wasted, 'files': [ ] })
+        groups[-1]['files'].append({ 'abs_path': abs_path, 'status': status })
+
+    next_cursor = None
+    if len(groups) == limit:
+        next_cursor = '%s:%s' % (groups[-1]['wasted'], groups[-1]['sha1'])
+    return groups, next_cursor
+
+def digest_index_path():
+    return current_app.config['DATABASE'] + '.digests'
+
+def get_digest_index():
+    """ The files table's DigestIndex - built once per command and kept in g
+
+        Rebuilt first if files changed since it was written. None if DIGEST_INDEX is off
+            or it's stale and we can't rebuild it (DB_READ_ONLY) - callers ask SQL then.
+    """
+    if not current_app.config.get('DIGEST_INDEX'): return None
+
+    if 'digest_index' not in g:
+        flush_writers() ## Stamp it with what's been written so far
+        db, ds = get_db()
+        g.digest_index = digest_index.load(db, digest_index_path(), get_hash_algo(),
+                                           not current_app.config.get('DB_READ_ONLY'))
+    return g.digest_index
+
+def known_sizes():
+    """ Return the set of file sizes already stored in the files table
+
+        The DigestIndex's sizes if there is one - a `size in` test on the mmap
+    """
+    index = get_digest_index()
+    if index is not None: return index.sizes
+
+    db, ds = get_db()
+
+    try:
+        return set( row['size'] for row in db.execute('SELECT DISTINCT size FROM files') )
+    except sqlite3.OperationalError: ## Nothing has been blessed / cursed yet
+        return set()
+
+def known_fingerprints():
+    """ Return { size: set(fingerprint) } for the files table - None means not known """
+    db, ds = get_db()
+
+    ret = { }
+    try:
+        rows = db.execute('SELECT size, fingerprint FROM files')
+        for row in rows:
+            ret.setdefault(row['size'], set()).add(row['fingerprint'])
+    except sqlite3.OperationalError: ## Rows from before fingerprints were stored
+        for size in known_sizes():
+            ret.setdefault(size, set()).add(None)
+    return ret
+
+## Just what test_unique() needs from a files row - much lighter than a FileNode
+IndexEntry = collections.namedtuple('IndexEntry', ['abs_path', 'name', 'sha1', 'size', 'status',
+                                                 'hash_algo'])
+
+class FileIndex():
+    """ abs_path / sha1 / name lookups for test_unique() - O(1) per file
+
+        Used as a wrapper to DB or to list([ FileNode ]) to make logic consistent.
+        The files table is loaded once into dicts unless it has more than max_rows
+        rows, then we fall back to querying SQL for every lookup.
+    """
+    @metrics.timed('index_load')
+    def __init__(self, file_list = None, max_rows = None, preload = True):
+        self.by_abs  = { }
+        self.by_sha1 = collections.defaultdict(list)
+        self.by_name = collections.defaultdict(list)
+        self.table = None
+
+        if isinstance(file_list, list): # if we get a list
+            for fNode in file_list: self.add(fNode)
+            return
+
+        if not preload: ## A few lookups - not worth reading the whole catalog for
+            self.table = get_dao()
+            return
+
+        db, ds = get_db() #Otherwise assume we're using the DB
+        try:
+            n_rows = db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        except sqlite3.OperationalError: ## No files table yet - nothing to match
+            return
+
+        if max_rows is not None and n_rows > max_rows:
+            self.table = get_dao() ## Too big to hold - see *_match() below
+            return
+
+        for row in db.execute('SELECT abs_path, name, sha1, size, status, hash_algo'
+                              ' FROM catalog'):
+            self.add( IndexEntry(*row) )
+
+    def add(self, fNode):
+        self.by_abs[fNode.abs_path] = fNode
+        self.by_sha1[(fNode.hash_algo, fNode.sha1)].append(fNode)
+        self.by_name[fNode.name].append(fNode)
+
+    def abs_match(self, abs_path):
+        if self.table is None:
+            return self.by_abs.get(abs_path)
+
+        metrics.current().count('db_queries')
+        match = self.table.lookup('catalog', abs_path=abs_path)
+        if match: return FileNode(match)
+        return None
+
+    def sha1_match(self, sha1, algo = None):
+        ## Digests only mean the same thing under the same algorithm
+        if algo is None: algo = get_hash_algo()
+
+        if self.table is None:
+            return self.by_sha1.get((algo, sha1), [ ])
+
+        ## Most digests hunt sees aren't in the catalog - say so without asking SQL
+        digests = get_digest_index()
+        if digests is not None and digests.algo == algo and not digests.known_digest(sha1):
+            return [ ]
+        metrics.current().count('db_queries')
+        return [ FileNode(match)
+                     for match in self.table.lookup_all('catalog', sha1=sha1, hash_algo=algo) ]
+
+    def name_match(self, name):
+        if self.table is None:
+            return self.by_name.get(name, [ ])
+        metrics.current().count('db_queries')
+        return [ FileNode(match) for match in self.table.lookup_all('catalog', name=name) ]
+
+def get_file_index(file_list = None, preload = True):
+    """ Build a FileIndex - the DB one is built once per command and kept in g
+
+        preload=False (one file - e.g. `bless FILE`) gives one that asks SQL per lookup
+            rather than loading the catalog - unless this command already loaded it.
+        NOTE: rows written during the command aren't added to the cached index
+    """
+    if isinstance(file_list, list):
+        return FileIndex(file_list)
+
+    if 'file_index' not in g:
+        if not preload: return FileIndex(preload=False)
+        g.file_index = FileIndex(max_rows=current_app.config['INDEX_MAX_ROWS'])
+    return g.file_index
+
+class Status(str, enum.Enum):
+    """ What we make of a file - still a str so `"BLESSED" in status`, == and the DB work """
+    BLESSED = 'BLESSED'
+    CURSED = 'CURSED'
+    NUKE = 'NUKE'
+    CHECK = 'CHECK'
+    NOTSURE = 'NOTSURE'
+    GOOD = 'GOOD'
+    UNKNOWN = 'unknown'
+
+    ## Behave exactly like the plain string when printed, formatted or used as a key
+    __str__ = str.__str__
+    __format__ = str.__format__
+    __hash__ = str.__hash__
+
+    @classmethod
+    def get(cls, state):
+        try:
+            return cls(state)
+        except ValueError: ## Whatever odd value the DB had - keep it (it shows blinking)
+            return state
+
+@functools.lru_cache(maxsize=None)
+def status_color(state):
+    """ ANSI colors for a status - only worked out when a node is actually printed """
+    ## FIXME: Add a check to keep BLESSED and CURSED nodes static no matter what
+    if "BLESSED" in state: 
+        ## purple = 'protect'
+        return colored.bg('purple_1b')
+    elif "CURSED" in state: 
+        ## red = 'ready to nuke'
+        return colored.bg('red_3a') + colored.attr(5) ## attr(5) is blink
+    elif "NUKE" in state:
+        ## red = 'ready to nuke'
+        return colored.bg('red_3a')
+    elif "CHECK" in state:
+        ## orange = 'OR-ange you sure it's not a match'
+        return colored.bg('dark_orange_3a')
+    elif "NOTSURE" in state:
+        ## new or navy = 'not sure | maybe unique - e.g. name seems to match'
+        return colored.bg('navy_blue')
+    elif "GOOD" in state: ## Note, this means new to the DB - NOT to the full dir!!
+        ## green = 'good to store'
+        return colored.bg('green')
+    elif "unknown" in state: # Default 'blue' for unknown
+        return colored.bg('blue')
+    else: #default blue + blink for unlikely case of bad status flag
+        return colored.bg('blue') + colored.attr(5)
+
+    ## Another idea for status
+    ## gold = 'golden master' - we've blessed this - ignore others
+    ## self.color == colored.bg('gold_3a'):
+
 class Node():
+    ## No per node __dict__ - a scan can hold millions of these
+    __slots__ = ('path', 'name')
+    table_name = None
+    color = ""
+
     def __init__(self, abs_path):
-        self.abs_path = abs_path
         path, name = os.path.split(abs_path)
-        self.table_name = None
-        self.path = path
+        self.path = sys.intern(path) ## Every file in a dir shares the one string
         self.name = name or "/" ### If name is none, then path is "/" and we're root
-        self.color = ""
+
+    @property
+    def abs_path(self):
+        return os.path.join(self.path, self.name)
 
     def __repr__(self):
         return self.color + os.path.join(self.path, self.name) + colored.attr('reset')
 
     def db_delete(self):
-        db, ds = get_db()
-
-        statement = 'DELETE FROM %s WHERE abs_path = "%s"' % (self.table_name, self.abs_path)
-        for row in ds.query(statement):
-            print("DELETING: %s" % (row) ) ## Doesn't happen because query returns None
+        return get_dao().delete(self.table_name, abs_path=self.abs_path)
 
     def db_add(self):
         pass
 
 class DirNode(Node):
+    ## abs_path is kept as given - e.g. with a trailing `/` it wouldn't survive a split
+    __slots__ = ('abs_path', 'mtime_ns', 'n_files', 'n_dirs')
+    table_name = 'dirs'
+    COLUMNS = ('abs_path', 'mtime_ns', 'n_files', 'n_dirs')
+
     def __init__(self, info):
 
         if isinstance(info, str): # if we get a string we're loading via filesystem
@@ -87,122 +951,107 @@ class DirNode(Node):
         else: #Otherwise assume we're loading an OrderedDict from the DB
             abs_path = info['abs_path']
             Node.__init__(self, abs_path)
+        self.abs_path = abs_path
 
-        self.table_name = 'dirs'
+        ## Filled in by set_scan() - see DirIndex
+        self.mtime_ns = None if isinstance(info, str) else info.get('mtime_ns')
+        self.n_files  = None if isinstance(info, str) else info.get('n_files')
+        self.n_dirs   = None if isinstance(info, str) else info.get('n_dirs')
 
         ## FIXME: For now being used for brevity's sake
         #self.parent = None # Intended as object version of path string
         #p, d = os.path.split(abs_path)
         #if d: self.parent = DirNode(p) # If d is None then we're at the top, i.e. '/'
 
-        self.color = colored.bg('dark_olive_green_3a')
+    @property
+    def color(self):
+        return colored.bg('dark_olive_green_3a')
+
+    def set_scan(self, st, n_files, n_dirs):
+        self.mtime_ns = st.st_mtime_ns
+        self.n_files = n_files
+        self.n_dirs = n_dirs
 
     def db_add(self):
         ### Will CREATE or UPDATE based on abs_path as unique key - OVERWRITE RISK!
 
-        db, ds = get_db()
-        table = ds[self.table_name]
-
         ## Not needed at present - creates full dir tree (back to '/' if we do)
         #if self.parent: self.parent.db_add()
 
-        entry = self.__dict__.copy()
-        entry.pop('color')
-        entry.pop('table_name')
-        entry.pop('parent') ### This MUST be deleted as obj type can't be stored in DB
-            ## We don't need to save it because self.path is the text representation
-
-        try:
-            table = ds[self.table_name]
-            table.upsert(entry, ['abs_path'])
-        except:
-            click.echo( "Error trying to ADD DIR: %s" % (self.abs_path) )
+        entry = { column: getattr(self, column) for column in self.COLUMNS }
+        get_writer(self.table_name).add(entry)
 
     def db_delete(self):
-        ## FIXME: This might leave dangling files if we delete Dir of multiple files
-        ##      DirNode Delete should be to delete the DirNode if no files point to it
+        ## Only goes if no files point to it - see DAO.delete_dir()
         #if self.parent: self.parent.db_delete() ## FIXME: Right now self.parent = None
-        Node.db_delete(self)
-        ## FIXME: Test gets complicated because DirNode needs to know about FileNode 
-            ##  (i.e. files table) to run query
+        return get_dao().delete_dir(self.abs_path)
 
 class FileNode(Node):
+    ## abs_path is rebuilt from path + name (see Node) and only the parts of the stat
+    ##     the HashCache needs are kept - see the `stat` property
+    __slots__ = ('sha1', 'hash_algo', 'fingerprint', 'status', 'size',
+                 'st_dev', 'st_ino', 'st_mtime_ns', 'score')
+    table_name = 'files'
+    COLUMNS = ('path', 'name', 'sha1', 'hash_algo', 'fingerprint', 'status', 'size')
+
     def __init__(self, info):
-        if isinstance(info, str): # if we get a string we're loading via filesystem
-            abs_path = info
+        if isinstance(info, (str, os.DirEntry, walker.CachedEntry)): # loading via filesystem
+            ## walker.walk() entries already carry their stat() - no need for another
+            abs_path = info if isinstance(info, str) else info.path
             Node.__init__(self, abs_path)
 
-            self.sha1 = None ## Don't auto hash for sha1, rely on get_hash() call
-            self.status = "unknown"
-            self.set_status(self.status)
-            self.size = os.path.getsize(abs_path)
+            ## Don't auto hash for sha1, rely on get_hash() call - unless a
+            ##     walker.CachedEntry (an unchanged dir on an incremental scan) has it
+            self.sha1 = getattr(info, 'sha1', None)
+            self.hash_algo = get_hash_algo()
+            self.fingerprint = getattr(info, 'fingerprint', None) ## Same for the head / tail
+            self.set_status(Status.UNKNOWN)
+
+            st = os.stat(abs_path) if isinstance(info, str) else info.stat()
+            self.st_dev, self.st_ino, self.st_mtime_ns = st.st_dev, st.st_ino, st.st_mtime_ns
+            self.size = st.st_size
 
         else: #Otherwise assume we're loading an OrderedDict from the DB
             
             abs_path = info['abs_path']
             Node.__init__(self, abs_path)
-            self.status = "unknown"
             self.sha1 = info['sha1']
+            self.hash_algo = sys.intern(info.get('hash_algo') or hasher.DEFAULT_ALGORITHM)
+            self.fingerprint = info.get('fingerprint') ## Older rows won't have one
+            self.st_dev = self.st_ino = self.st_mtime_ns = None
             self.size = info['size']
             self.set_status( info['status'] )
 
-        self.table_name = 'files'
         ## FIXME: Not being used at the moment
         #self.parent = DirNode(self.path) ## Convenience object vs. self.path string
 
+    @property
+    def stat(self):
+        """ walker.CachedStat for HashCache lookups - None for nodes loaded from the DB """
+        if self.st_dev is None: return None
+        return walker.CachedStat(self.st_dev, self.st_ino, self.size, self.st_mtime_ns)
+
+    @property
+    def color(self):
+        return status_color(self.status)
+
     def set_status(self, state = "BLESSED"):
-        self.status = state
-
-        ## FIXME: Add a check to keep BLESSED and CURSED nodes static no matter what
-        if "BLESSED" in state: 
-            ## purple = 'protect'
-            self.color = colored.bg('purple_1b')
-        elif "CURSED" in state: 
-            ## red = 'ready to nuke'
-            self.color = colored.bg('red_3a') + colored.attr(5) ## attr(5) is blink
-        elif "NUKE" in state:
-            ## red = 'ready to nuke'
-            self.color = colored.bg('red_3a')
-        elif "CHECK" in state:
-            ## orange = 'OR-ange you sure it's not a match'
-            self.color = colored.bg('dark_orange_3a')
-        elif "NOTSURE" in state:
-            ## new or navy = 'not sure | maybe unique - e.g. name seems to match'
-            self.color = colored.bg('navy_blue')
-        elif "GOOD" in state: ## Note, this means new to the DB - NOT to the full dir!!
-            ## green = 'good to store'
-            self.color = colored.bg('green')
-        elif "unknown" in state: # Default 'blue' for unknown
-            self.color = colored.bg('blue')
-        else: #default blue + blink for unlikely case of bad status flag
-            self.color = colored.bg('blue') + colored.attr(5)
-
-        ## Another idea for status
-        ## gold = 'golden master' - we've blessed this - ignore others
-        ## self.color == colored.bg('gold_3a'):
+        self.status = Status.get(state)
 
+    @metrics.timed('db_add')
     def db_add(self):
         ### Will CREATE or UPDATE based on abs_path as unique key
         ##
         ## FIXME: May overwrite "BLESSED" / "CURSED" e.g. with something like "unknown"
         ## FIXME: Consider only saving BLESSED | CURSED | unknown states even if "GOOD"
-        db, ds = get_db()
-        table = ds[self.table_name]
-
         if not self.sha1: self.get_hash()
+        if not self.fingerprint: self.get_fingerprint()
         #if self.parent: self.parent.db_add()
 
-        entry = self.__dict__.copy()
-        entry.pop('color')
-        entry.pop('table_name')
-        #entry.pop('parent') ### This MUST be deleted as obj type can't be stored in DB
-            ## self.path is also the text representation so we don't need to save
+        entry = { column: getattr(self, column) for column in self.COLUMNS }
+        entry['status'] = str(self.status) ## Plain str for the DB driver, not the Status enum
 
-        try:
-            table = ds[self.table_name]
-            table.upsert(entry, ['abs_path'])
-        except:
-            click.echo( "Error trying to ADD FILE: %s" % (self.abs_path) )
+        get_writer(self.table_name).add(entry) ## Batched - see BulkWriter
 
     def db_delete(self):
         Node.db_delete(self)
@@ -210,54 +1059,76 @@ class FileNode(Node):
         #if self.parent: self.parent.db_delete() ## Child should suggest to parent 
 
     def get_hash(self):
-        db, ds = get_db()
+        if self.needs_hash():
+            self.set_hash( self.calculate_hash() )
 
+        return self.sha1
+
+    def set_hash(self, sha1, verified = True):
+        ## verified: sha1 came from reading the file - see HashCache
+        self.sha1 = sha1
+        if self.stat: get_hash_cache().put(self.stat, self.abs_path, sha1, self.hash_algo,
+                                           verified)
+
+    def needs_hash(self):
+        ### Try to answer get_hash() from the DBs - True means only a full read will do
+        ##     Split out of get_hash() so hasher.hash_nodes() can do the reads in parallel
         if self.sha1:
-            return self.sha1
-        else: 
+            return False
+
+        if self.stat: ## Same inode, size and mtime as when we last read it
+            sha1 = get_hash_cache().get(self.stat, self.abs_path, self.hash_algo)
+            if sha1:
+                self.sha1 = sha1
+                return False
+
+        ##rather than just recalculate - query DB to see if we're already stored
+        ## FIXME: Potential bug if DB file differs from Filesystem version
+        ##      Based on the use case I'm willing to accept this risk
+        with metrics.current().phase('db_lookup'):
+            db_entry = get_dao().lookup('catalog', abs_path=self.abs_path)
+        metrics.current().count('db_queries')
+
+        if db_entry and 'size' in db_entry.keys() and self.size != db_entry['size']: 
+            ## FIXME: This is an impartial sub-HASH test
+            click.echo("get_hash: BAD SIZE + HASH for: %s" % (self.abs_path) )
+            self.sha1 = None
+        elif db_entry and db_entry.get('sha1') and \
+                (db_entry.get('hash_algo') or hasher.DEFAULT_ALGORITHM) == self.hash_algo:
+            ## Into the HashCache too so DirIndex.reuse() finds the whole dir cached - but
+            ##     not as verified, the file may have been rewritten in place since
+            self.set_hash( db_entry['sha1'], verified=False )
+            metrics.current().count('db_hash_hits')
+        else:
+            return True
 
-            try:
-                HASH_DB_PATH = 'sqlite:///' + \
-                               '/Users/wjhuie/bin/instance/cleansweep_hashes.sqlite'
+        return False
 
-                db = dataset.connect(HASH_DB_PATH)
-                hash_ds = db['hashes']
+    @metrics.timed('hash')
+    def calculate_hash(self):
+        metrics.current().count('files_hashed')
+        metrics.current().count('bytes_hashed', self.size)
+        return hasher.hash_file(self.abs_path, self.hash_algo)
 
-                db_entry = hash_ds.find_one(abs_path=self.abs_path)
+    def get_fingerprint(self):
+        if self.needs_fingerprint():
+            metrics.current().count('files_fingerprinted')
+            self.set_fingerprint( hasher.fingerprint_file(self.abs_path, self.size) )
 
-                if db_entry:
-                    self.sha1 = db_entry['sha1']
-                    return self.sha1
-            except:
-                pass ## If we can't find ourselves in special HASHES DB try files
-
-            ##rather than just recalculate - query DB to see if we're already stored
-            ## FIXME: Potential bug if DB file differs from Filesystem version
-            ##      Based on the use case I'm willing to accept this risk
-            db_entry = ds[self.table_name].find_one(abs_path=self.abs_path)
-
-            if db_entry and 'size' in db_entry.keys() and self.size != db_entry['size']: 
-                ## FIXME: This is an impartial sub-HASH test
-                click.echo("get_hash: BAD SIZE + HASH for: %s" % (self.abs_path) )
-                self.sha1 = None
-            elif db_entry and 'sha1' in db_entry.keys():
-                self.sha1 = db_entry['sha1']
-            else:
-                self.sha1 = self.calculate_hash()
+        return self.fingerprint
 
-        return self.sha1
+    def set_fingerprint(self, fingerprint):
+        self.fingerprint = fingerprint
+        if self.stat: get_hash_cache().set_fingerprint(self.stat, fingerprint)
 
-    def calculate_hash(self):
-        BLOCKSIZE = 65536
-        hasher = hashlib.sha1()
+    def needs_fingerprint(self):
+        ### Like needs_hash() - True means the file has to be opened
+        if self.fingerprint:
+            return False
 
-        with open(self.abs_path, 'rb') as afile:
-            buf = afile.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = afile.read(BLOCKSIZE)
-        h = hasher.hexdigest()
-        return h
+        if self.stat: ## Kept with the digest the last time we read it
+            self.fingerprint = get_hash_cache().fingerprint(self.stat)
+        return not self.fingerprint
 
     def shade_unique(self, lower_T = 400, upper_T = 900):
         try:
@@ -286,7 +1157,8 @@ class FileNode(Node):
         else:
             self.set_status("NOTSURE")# > 0 but < lower_T - likely name match only
 
-    def test_unique(self, file_list = None):
+    @metrics.timed('score') ## NOTE: includes any hashing it has to do
+    def test_unique(self, file_list = None, sizes = None, fingerprints = None):
         ### Set color based on uniqueness logic - also return [<0, 0 , >0] depending 
         ###     <0 => Assume  unique, >0 => Assume NOT unique, =0 => Unsure         
         ## Cases to consider
@@ -299,46 +1171,17 @@ class FileNode(Node):
         ## NOTE: THIS ONLY CHECKS THE DB - not against other files in the same dir
         ##       meaning multiple files may NOT be 'NEW / UNIQUE' in the FS vs. DB scan
         ## NOTE All numerical "scoring" values are arbitary 
+        ##
+        ## If `sizes` is passed (see known_sizes()) a file whose size isn't in it
+        ##     can't have a hash match so we never read it - name matches still count
+        ##     Same for `fingerprints` (see known_fingerprints()) keyed on (size, fingerprint)
 
-        ### Used as a wrapper to DB or to list([ FileNode ]) to make logic consistent
-        class file_source():
-            def __init__(self, file_list = None):
-                if isinstance(file_list, list): # if we get a list
-                    self.table = file_list
-                else: #Otherwise assume we're using the DB
-                    db, ds = get_db()
-                    self.table = ds['files']
-
-            def abs_match(self, abs_path):
-                if isinstance(self.table, list): # if we get a list
-                    for fNode in self.table:
-                        if fNode.abs_path == abs_path: return fNode
-                else: #Otherwise assume we're using the DB
-                    match = self.table.find_one(abs_path=abs_path)
-                    if match: return FileNode(match)
-                return None
-
-            def sha1_match(self, sha1):
-                if isinstance(self.table, list): # if we get a list
-                    for fNode in self.table:
-                        if fNode.sha1 == sha1: yield fNode
-                else: #Otherwise assume we're using the DB
-                    for match in self.table.find(sha1=sha1):
-                        yield FileNode(match)
-                return None
-
-            def name_match(self, name):
-                if isinstance(self.table, list): # if we get a list
-                    for fNode in self.table:
-                        if fNode.name == name: yield fNode
-                else: # Otherwise assume we're using the DB
-                    for match in self.table.find(name=name):
-                        yield FileNode(match)
-                return None
-
-        self.get_hash()
-
-        FILES = file_source(file_list)
+        could_match = sizes is None or self.size in sizes
+        if could_match and fingerprints is not None:
+            could_match = (self.size, self.get_fingerprint()) in fingerprints
+        if could_match: self.get_hash()
+
+        FILES = file_list if isinstance(file_list, FileIndex) else get_file_index(file_list)
 
         ## Good is < 0 so we can set pruning thresholds > 0
         ## numbers are arbitrary and used in CLI logic to set thresholds
@@ -364,7 +1207,9 @@ class FileNode(Node):
                 self.set_status( "unknown" )
                 return 0
 
-            if self.sha1 and self.sha1 != abs_match.sha1: # No use testing `None`
+            ## No use testing `None` - or a digest from another algorithm
+            if self.sha1 and self.hash_algo == abs_match.hash_algo and \
+                    self.sha1 != abs_match.sha1:
                 click.echo("test_unique: BAD HASH for: %s" % (self.abs_path) )
                 self.set_status( "unknown" )
                 return 0 ## FIXME: Should we _do_ anything else here to recover?
@@ -393,12 +1238,12 @@ class FileNode(Node):
         ##            This is acceptable for our planned use case
         ##
         ## NOTE: IF we don't have a sha1 get_hash() can/will overwrite with DB #'s
-        if not self.sha1: self.get_hash()
+        if could_match and not self.sha1: self.get_hash()
         ret = -1 # using < 0 so as to default in CLI to saving vs. unknown
 
         ## This will be a true hash match - NOT an abs_path match which happens above
         ## NOTE: if hash matches then size is almost certainly a match so not checking
-        for hash_match in FILES.sha1_match(self.sha1):
+        for hash_match in (FILES.sha1_match(self.sha1, self.hash_algo) if could_match else [ ]):
             if self.abs_path == hash_match.abs_path: continue # don't count self
             ret += 1000  # Arbitrary threshold / heuristic
             if "CURSED" in hash_match.status: ret *= 2 # BAD IF WE MATCH CURSED
@@ -6,12 +6,32 @@ from markupsafe import escape
 
 def create_app(test_config=None):
     from . import cli
+    from . import AppDB
+    from . import browse
+    from . import hasher
+    from . import jobs
 
     app = Flask(__name__, instance_relative_config=True)
 
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'cleansweep.sqlite'),
+        HASH_CACHE=os.path.join(app.instance_path, 'cleansweep_hashes.sqlite'),
+        HASH_ALGORITHM='sha1', # any fixed size hashlib digest - e.g. blake2b, sha256
+        HASH_BLOCK_SIZE=1024 * 1024, # bytes per read when hashing - one buffer reused per file
+        HASH_MMAP_MIN=0, # mmap files at least this big instead of reading them (0 = never)
+        HASH_FADVISE=True, # posix_fadvise SEQUENTIAL + DONTNEED - keep hashing out of the page cache
+        METRICS=False, # print counters + phase timings after every command - same as --profile
+        METRICS_HOOK=None, # callable (or 'module:function') given each command's metrics dict
+        DB_BATCH_SIZE=1000, # rows per transaction for bless / curse / hash_scan writes
+        DB_SYNCHRONOUS='NORMAL', # sqlite PRAGMA synchronous - NORMAL is safe with WAL
+        INDEX_MAX_ROWS=5000000, # files rows to hold in memory for test_unique() else SQL
+        DIGEST_INDEX=True, # mmap digest + size index beside DATABASE - "is it known?" without SQL
+        BROWSE_PAGE_SIZE=100, # dirs per page from `/`
+        BROWSE_CACHE_SIZE=4096, # dir listings kept in memory - keyed by dir mtime
+        BROWSE_WORKERS=8, # threads counting sub dirs for `/`
+        JOB_WORKERS=2, # background scans (POST /jobs) run at once - the rest queue
+        JOB_HISTORY=100, # finished jobs kept for GET /jobs
         DST_DIR_NAME=os.path.join(app.instance_path, 'CleanSwept'),
     )
 
@@ -31,49 +51,86 @@ def create_app(test_config=None):
     if not os.path.exists( app.config['DST_DIR_NAME'] ):
         os.makedirs(app.config['DST_DIR_NAME'])
 
+    hasher.check_algorithm( app.config['HASH_ALGORITHM'] ) ## Fail now, not mid scan
+    hasher.configure( app.config['HASH_BLOCK_SIZE'], app.config['HASH_MMAP_MIN'],
+                      app.config['HASH_FADVISE'] )
+
     #endpoint for search
     @app.route('/search', methods=['GET', 'POST'])
     def search():
-        if request.method == "POST":
-            search_string = request.form['search_string']
-
+        ## GET with ?search_string= is how the "next page" links come back in
+        search_string = request.values.get('search_string')
+        if search_string:
             app.logger.debug("Searching for: %s" % (search_string) )
 
-            data = { } # This would be where to query DB based on...
+            data, cursor = [ ], None # This would be where to query DB based on...
             if "hashes" in search_string:
-                db, ds = AppDB.get_db()
+                try:
+                    data, cursor = AppDB.duplicate_groups(request.args.get('cursor'),
+                                                          request.args.get('limit', 50, type=int))
+                except ValueError:
+                    return jsonify({ 'error': 'bad cursor' }), 400
 
-                for h in ds['files'].distinct('sha1'):
-                    sha1 = h['sha1']
-                    app.logger.debug("Hashes for: %s" % (sha1))
-                    data[sha1] = [ ]
-                    for f in ds['files'].find(sha1=h['sha1'], order_by='abs_path', limit=1):
-                        app.logger.debug("\t %s" % (f['abs_path']))
-                        data[sha1].append( f['abs_path'] )
-
-            return render_template('search.html', data=data)
+            return render_template('search.html', data=data, cursor=cursor,
+                                   search_string=search_string)
 
         return render_template('search.html')
 
+    #endpoint for duplicate groups as JSON - ?cursor= from the previous page's `next`
+    @app.route('/api/duplicates')
+    def duplicates():
+        try:
+            groups, cursor = AppDB.duplicate_groups(request.args.get('cursor'),
+                                                    request.args.get('limit', 50, type=int))
+        except ValueError:
+            return jsonify({ 'error': 'bad cursor' }), 400
+
+        return jsonify({ 'groups': groups, 'next': cursor })
+
+    #endpoints for background scans - POST kind (bless | hunt | hash_scan | migrate_digests)
+    #    + path, then poll
+    @app.route('/jobs', methods=['GET', 'POST'])
+    def job_list():
+        if request.method == 'GET':
+            return jsonify({ 'jobs': [ job.progress() for job in jobs.get_manager().list() ] })
+
+        params = request.get_json(silent=True) or request.values
+        path = params.get('path')
+        if not path or not os.path.isdir(path):
+            return jsonify({ 'error': 'path must be an existing directory' }), 400
+
+        try:
+            job = jobs.get_manager().submit(params.get('kind'), os.path.abspath(path),
+                                            jobs.parse_options(params))
+        except ValueError as e:
+            return jsonify({ 'error': str(e) }), 400
+
+        return jsonify(job.progress()), 202, { 'Location': url_for('job', job_id=job.id) }
+
+    #progress (GET) or cancel (DELETE) one job
+    @app.route('/jobs/<job_id>', methods=['GET', 'DELETE'])
+    def job(job_id):
+        manager = jobs.get_manager()
+        job = manager.cancel(job_id) if request.method == 'DELETE' else manager.get(job_id)
+        if job is None:
+            return jsonify({ 'error': 'no such job' }), 404
+
+        return jsonify(job.progress()), 202 if request.method == 'DELETE' else 200
+
     @app.route('/')
     def index(directory = None):
         if not directory: directory = request.args.get('directory')
         if not directory: directory = os.getcwd()
 
         app.logger.debug("Scanning Directory: %s" % (directory) )
- 
-        ret = { }
-        for d in [ d for d in os.scandir(directory) if d.is_dir() ]:
-            if not cli.check_dir(d.path): continue ## Skip directories that don't pass
-    
-            app.logger.debug("Scanning: / %s" % (d.path) )
-
-            ret[d.path] = {'path': d.path, 'name': d.name }
-            try:
-                ret[d.path]['sub_dirs'] = [ s.name for s in os.scandir(d) if os.path.isdir(s) ]
-                ret[d.path]['n_sub_dirs'] = len( ret[d.path]['sub_dirs'] ) 
-            except:
-                continue
+
+        offset = request.args.get('offset', 0, type=int)
+        limit  = request.args.get('limit', app.config['BROWSE_PAGE_SIZE'], type=int)
+
+        try:
+            ret = browse.list_dir(directory, offset, limit) ## It clamps both
+        except OSError as e:
+            return jsonify({ 'error': str(e) }), 404
 
         return jsonify(ret)
 #        return json.dumps(ret), {'Content-Type': 'application/json'}
@@ -92,13 +149,19 @@ def create_app(test_config=None):
         app.cli.add_command(cli.curse_command) # CURSE file(s)
         app.cli.add_command(cli.bless_command) # BLESS file(s)
         app.cli.add_command(cli.hash_scan_command) # SPECIAL TO ADD TO HASH DB
+        app.cli.add_command(cli.migrate_digests_command) # Re-digest to HASH_ALGORITHM
+        app.cli.add_command(cli.catalog_export_command) # Snapshot the catalog to a file
+        app.cli.add_command(cli.catalog_import_command) # Merge another host's snapshot
 
         app.cli.add_command(cli.fs_ls_command) # Recursively scan dir and CMP files
+        app.cli.add_command(cli.fs_dups_command) # Recursively find dups inside a dir
 
         app.cli.add_command(cli.fs_hunt_command) # Recursively find files to DEL!
         app.cli.add_command(cli.fs_clean_command) # Recursively delete files
         app.cli.add_command(cli.fs_sweep_command) # Recursively move unique files
 
+        app.cli.add_command(cli.bench_command) # Time commands on a generated tree
+
     init_app(app)
 
     return app
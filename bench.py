@@ -0,0 +1,279 @@
+import os
+import sys
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+from . import AppDB
+from . import hasher
+from . import walker
+
+## Defaults for generate_tree() - small enough to run in a few seconds
+TREE_DEFAULTS = { 'seed': 0, 'dirs': 20, 'depth': 2, 'files': 40, 'sizes': 'lognormal:9:2',
+                  'max_size': 8 * 1024 * 1024, 'dup_ratio': 0.2, 'hidden_ratio': 0.1,
+                  'collision_ratio': 0.1 }
+
+def parse_sizes(spec):
+    """ 'fixed:N' | 'uniform:LOW:HIGH' | 'lognormal:MU:SIGMA' -> f(rng) giving a size """
+    kind, _, args = spec.partition(':')
+    args = [ float(a) for a in args.split(':') if a ]
+
+    if kind == 'fixed' and len(args) == 1:
+        return lambda rng: int(args[0])
+    if kind == 'uniform' and len(args) == 2:
+        return lambda rng: rng.randint(int(args[0]), int(args[1]))
+    if kind == 'lognormal' and len(args) == 2:
+        return lambda rng: int(rng.lognormvariate(args[0], args[1]))
+    raise ValueError('Bad size distribution: %s' % (spec))
+
+def generate_tree(root, seed = 0, dirs = 20, depth = 2, files = 40, sizes = 'lognormal:9:2',
+                  max_size = 8 * 1024 * 1024, dup_ratio = 0.2, hidden_ratio = 0.1,
+                  collision_ratio = 0.1):
+    """ Write a reproducible tree of files under root - the same arguments give the same bytes
+
+        `dirs` top level dirs each `depth` levels deep with `files` files per dir.
+        dup_ratio of files copy an earlier file's content, collision_ratio reuse an earlier
+            name (new content) and hidden_ratio of dirs start with `.` (never scanned).
+        Returns counts of what was written - see run_benchmarks()
+    """
+    rng = random.Random(seed)
+    size_of = parse_sizes(sizes)
+
+    stats = { 'files': 0, 'bytes': 0, 'dups': 0, 'collisions': 0, 'hidden_files': 0,
+              'dirs': 0, 'hidden_dirs': 0, 'empty': 0 }
+    contents, names = [ ], [ ]
+
+    for d in range(dirs):
+        hidden = rng.random() < hidden_ratio
+        path = os.path.join(root, '%sd%d' % ('.' if hidden else '', d))
+
+        for level in range(depth):
+            path = os.path.join(path, 's%d' % (level))
+            os.makedirs(path, exist_ok=True)
+            stats['dirs'] += 1
+            if hidden: stats['hidden_dirs'] += 1
+
+            for f in range(files):
+                if names and rng.random() < collision_ratio:
+                    name = rng.choice(names)
+                    stats['collisions'] += 1
+                else:
+                    name = 'f%d_%d_%d.bin' % (d, level, f)
+                    names.append(name)
+
+                if contents and rng.random() < dup_ratio:
+                    data = rng.choice(contents)
+                    stats['dups'] += 1
+                else:
+                    data = rng.randbytes(min(max(size_of(rng), 0), max_size))
+                    if data: contents.append(data)
+
+                with open(os.path.join(path, name), 'wb') as afile:
+                    afile.write(data)
+
+                stats['files'] += 1
+                stats['bytes'] += len(data)
+                if hidden: stats['hidden_files'] += 1
+                if not data: stats['empty'] += 1
+
+    return stats
+
+def git_commit():
+    """ HEAD of the repo we're running from - None outside a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@contextlib.contextmanager
+def cwd(path):
+    ## `ls` only ever looks at os.getcwd()
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+def timed(results, name, f, *args):
+    start = time.perf_counter()
+    ret = f(*args)
+    results.setdefault(name, [ ]).append( time.perf_counter() - start )
+    return ret
+
+def make_app(work_dir, config = None):
+    """ A throw away app - its own DB, hash cache and sweep dir under work_dir """
+    from . import create_app
+
+    test_config = { 'TESTING': True,
+                    'DATABASE': os.path.join(work_dir, 'bench.sqlite'),
+                    'HASH_CACHE': os.path.join(work_dir, 'bench_hashes.sqlite'),
+                    'DST_DIR_NAME': os.path.join(work_dir, 'CleanSwept') }
+    test_config.update(config or { })
+    return create_app(test_config)
+
+def cli_invoker(app):
+    """ invoke(*args) - run a `flask` command against app, RuntimeError if it fails """
+    runner = app.test_cli_runner()
+
+    def invoke(*args):
+        ## with_appcontext reuses whatever app is current - e.g. the one running
+        ##     `flask bench` - so push ours or the commands write to the real DB
+        with app.app_context():
+            result = runner.invoke(args=list(args))
+        if result.exit_code != 0:
+            raise RuntimeError('%s failed: %s' % (' '.join(args), result.output[-500:]))
+        return result.output
+    return invoke
+
+def rewrite(abs_path, data):
+    ## Same size, new content - and an mtime that's certain to differ on coarse clocks
+    st = os.stat(abs_path)
+    with open(abs_path, 'wb') as afile:
+        afile.write(data)
+    os.utime(abs_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+def check_rewrites(work_dir, config = None):
+    """ X_clean must notice files rewritten in place (same size) since the DB saw them
+
+        Each case stats a keeper / candidate, rewrites it behind the DB's back and
+            cleans - nothing may be deleted on the strength of a digest we didn't read.
+        Raises RuntimeError naming the first file that was lost
+    """
+    cases = [ ]
+
+    ## A blessed keeper rewritten then hunted - the copy it vouched for must stay
+    case_dir = os.path.join(work_dir, 'keeper')
+    for name in ('keep', 'other'): os.makedirs(os.path.join(case_dir, name))
+    keeper = os.path.join(case_dir, 'keep', 'k.bin')
+    copy = os.path.join(case_dir, 'other', 'copy.bin')
+    with open(keeper, 'wb') as afile: afile.write(b'ORIGINAL')
+
+    invoke = cli_invoker(make_app(case_dir, config))
+    invoke('init-db')
+    invoke('bless', os.path.dirname(keeper))
+    rewrite(keeper, b'MODIFIED')
+    with open(copy, 'wb') as afile: afile.write(b'ORIGINAL')
+    invoke('hunt', os.path.dirname(keeper))
+    invoke('X_clean', os.path.dirname(copy), '--no-dry-run')
+    cases.append(copy)
+
+    ## A cursed file rewritten - it isn't what was cursed any more
+    case_dir = os.path.join(work_dir, 'cursed')
+    os.makedirs(case_dir)
+    cursed = os.path.join(case_dir, 'c.bin')
+    with open(cursed, 'wb') as afile: afile.write(b'ORIGINAL')
+
+    invoke = cli_invoker(make_app(case_dir, config))
+    invoke('init-db')
+    invoke('curse', cursed)
+    rewrite(cursed, b'MODIFIED')
+    invoke('X_clean', case_dir, '--no-dry-run')
+    cases.append(cursed)
+
+    for abs_path in cases:
+        if not os.path.exists(abs_path):
+            raise RuntimeError('X_clean deleted %s after it was rewritten in place' % (abs_path) )
+
+def bench_commands(app, tree, blessed, results, jobs = 1):
+    """ Each command end to end through the CLI - in the order a user would run them """
+    invoke = cli_invoker(app)
+
+    jobs = '%d' % (jobs)
+    timed(results, 'bless', invoke, 'bless', blessed, '-j', jobs)
+    timed(results, 'hunt', invoke, 'hunt', tree, '--all', '-j', jobs)
+    timed(results, 'hunt_cached', invoke, 'hunt', tree, '--all', '-j', jobs)
+    with cwd(tree):
+        timed(results, 'ls', invoke, 'ls', '--all', '-j', jobs)
+    timed(results, 'hash_scan', invoke, 'hash_scan', tree, '-j', jobs)
+
+    client = app.test_client()
+    def search():
+        cursors = [ None ]
+        while True: ## Every page - like someone clicking `next` to the end
+            reply = client.get('/api/duplicates', query_string={ 'cursor': cursors[-1] }
+                               if cursors[-1] else { })
+            cursor = reply.get_json()['next']
+            if not cursor: return cursors
+            cursors.append(cursor)
+    cursors = timed(results, 'search', search)
+
+    def search_html():
+        ## The same pages rendered by `/search` - its `next` links carry these cursors
+        for cursor in cursors:
+            query = { 'search_string': 'hashes' }
+            if cursor: query['cursor'] = cursor
+            client.get('/search', query_string=query)
+    timed(results, 'search_html', search_html)
+
+def bench_phases(app, tree, results, jobs = 1):
+    """ walk / hash / score / db on their own - run against a fresh DB and hash cache """
+    with app.app_context():
+        nodes = timed(results, 'phase_walk',
+                      lambda: [ AppDB.FileNode(entry) for entry in walker.walk(tree) ])
+        timed(results, 'phase_hash', lambda: list(hasher.hash_nodes(nodes, jobs)))
+
+        index = AppDB.get_file_index()
+        timed(results, 'phase_score',
+              lambda: [ fNode.test_unique(file_list=index) for fNode in nodes ])
+
+        def db():
+            for fNode in nodes:
+                fNode.set_status('BLESSED')
+                fNode.db_add()
+            AppDB.get_writer('files').flush()
+        timed(results, 'phase_db', db)
+
+def summarize(seconds):
+    ordered = sorted(seconds)
+    return { 'runs': seconds, 'best': ordered[0], 'median': ordered[len(ordered) // 2],
+             'mean': sum(seconds) / len(seconds) }
+
+def run_benchmarks(root = None, repeat = 3, jobs = 1, config = None, echo = print, **tree):
+    """ Generate a tree (under root, or a temp dir we clean up) and time everything
+
+        Every repeat gets a new DB and hash cache so runs don't warm each other up -
+            the OS page cache is shared though, so repeats after the first read warm.
+        check_rewrites() runs first - there's no point timing a clean that loses files.
+        Returns a dict ready for json.dump() - keyed by benchmark, see summarize()
+    """
+    spec = dict(TREE_DEFAULTS, **tree)
+    work_dir = tempfile.mkdtemp(prefix='cleansweep-bench-')
+    tree_dir = root or os.path.join(work_dir, 'tree')
+
+    try:
+        echo('Checking X_clean against files rewritten in place')
+        check_dir = os.path.join(work_dir, 'checks')
+        os.makedirs(check_dir)
+        check_rewrites(check_dir, config)
+
+        echo('Generating tree in %s' % (tree_dir) )
+        stats = generate_tree(tree_dir, **spec)
+        blessed = os.path.join(tree_dir, sorted(d for d in os.listdir(tree_dir)
+                                                if not d.startswith('.'))[0])
+
+        results = { }
+        for n in range(repeat):
+            echo('Run %d / %d' % (n + 1, repeat))
+            run_dir = os.path.join(work_dir, 'run%d' % (n))
+            os.makedirs(run_dir)
+            bench_commands(make_app(run_dir, config), tree_dir, blessed, results, jobs)
+
+            phase_dir = os.path.join(work_dir, 'phase%d' % (n))
+            os.makedirs(phase_dir)
+            bench_phases(make_app(phase_dir, config), tree_dir, results, jobs)
+    finally:
+        AppDB.forget_hash_caches(work_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return { 'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+             'python': sys.version.split()[0], 'platform': platform.platform(),
+             'repeat': repeat, 'jobs': jobs, 'config': config or { },
+             'tree': spec, 'tree_stats': stats,
+             'results': { name: summarize(seconds) for name, seconds in results.items() } }
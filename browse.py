@@ -0,0 +1,90 @@
+import os
+import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from . import cli
+
+## { (kind, abs_path): (st_mtime_ns, [ names ]) } - good until that dir's mtime moves
+_LISTINGS = collections.OrderedDict()
+_LOCK = threading.Lock()
+_POOL = { } ## { pid: ThreadPoolExecutor } - shared by every request in this process
+
+MAX_PAGE = 1000 ## Most dirs one list_dir() page will hold - each is a scandir() to count
+
+def _cached(key, mtime_ns):
+    with _LOCK:
+        hit = _LISTINGS.get(key)
+        if hit and hit[0] == mtime_ns:
+            _LISTINGS.move_to_end(key)
+            return hit[1]
+    return None
+
+def _store(key, mtime_ns, names, cache_size):
+    with _LOCK:
+        _LISTINGS[key] = (mtime_ns, names)
+        _LISTINGS.move_to_end(key)
+        while len(_LISTINGS) > cache_size:
+            _LISTINGS.popitem(last=False)
+
+def child_dirs(directory):
+    """ Sorted names of the dirs under `directory` that pass cli.check_dir() """
+    st = os.stat(directory)
+    names = _cached(('dirs', directory), st.st_mtime_ns)
+
+    if names is None:
+        names = sorted( d.name for d in os.scandir(directory)
+                        if d.is_dir() and cli.check_dir(d.path) )
+        _store(('dirs', directory), st.st_mtime_ns, names,
+               current_app.config['BROWSE_CACHE_SIZE'])
+    return names
+
+def sub_dirs(path, cache_size):
+    """ Names of every dir directly under `path` - None if we can't read it
+
+        NOTE: Runs on the pool so it must not touch current_app
+    """
+    try:
+        st = os.stat(path)
+        names = _cached(('subs', path), st.st_mtime_ns)
+
+        if names is None:
+            names = [ s.name for s in os.scandir(path) if s.is_dir() ]
+            _store(('subs', path), st.st_mtime_ns, names, cache_size)
+        return names
+    except OSError:
+        return None
+
+def get_pool():
+    if os.getpid() not in _POOL:
+        _POOL[os.getpid()] = ThreadPoolExecutor(current_app.config['BROWSE_WORKERS'])
+    return _POOL[os.getpid()]
+
+def list_dir(directory, offset = 0, limit = 100):
+    """ One page of `directory`'s sub dirs with their own sub dir counts
+
+        Returns the same { path: {path, name, sub_dirs, n_sub_dirs} } entries the `/`
+        route always has plus paging info - `next` is the offset of the next page.
+        limit is held to 1 .. MAX_PAGE.
+    """
+    offset, limit = max(offset, 0), min(max(limit, 1), MAX_PAGE)
+    names = child_dirs(directory)
+    page = names[offset:offset + limit]
+    paths = [ os.path.join(directory, name) for name in page ]
+
+    count = functools.partial(sub_dirs, cache_size=current_app.config['BROWSE_CACHE_SIZE'])
+
+    ret = { }
+    for path, name, subs in zip(paths, page, get_pool().map(count, paths)):
+        ret[path] = { 'path': path, 'name': name }
+        if subs is None: continue ## Same as before - listed, just without counts
+
+        ret[path]['sub_dirs'] = subs
+        ret[path]['n_sub_dirs'] = len(subs)
+
+    more = offset + limit < len(names)
+    return { 'directory': directory, 'offset': offset, 'limit': limit,
+             'total': len(names), 'next': offset + limit if more else None, 'dirs': ret }
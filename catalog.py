@@ -0,0 +1,161 @@
+import gzip
+import json
+import time
+import socket
+import operator
+
+from flask import g
+
+from . import AppDB
+from . import metrics
+
+FORMAT = 'cleansweep-catalog'
+VERSION = 1
+
+FILE_COLUMNS = ('path', 'name', 'sha1', 'hash_algo', 'fingerprint', 'status', 'size')
+HASH_COLUMNS = ('abs_path', 'size', 'mtime_ns', 'sha1', 'algo')
+
+## Higher wins a merge - ties keep the row we already have
+RANK = '''(CASE WHEN instr(%(s)s, 'BLESSED') THEN 2
+                WHEN instr(%(s)s, 'CURSED') THEN 1 ELSE 0 END)'''
+
+def _write_section(out, table, columns, rows):
+    ## A section is its header object then one JSON list per row
+    out.write(json.dumps({ 'table': table, 'columns': columns }) + '\n')
+
+    n = 0
+    for row in rows:
+        out.write(json.dumps(list(row), separators=(',', ':')) + '\n')
+        n += 1
+    return n
+
+def export_catalog(out_path, hashes = True, compresslevel = 6):
+    """ Write the files table (plus the hash cache) as a gzipped JSON lines snapshot
+
+        Rows are sorted by (dir, name) so snapshots of the same catalog are identical
+            and compress well - hash cache rows drop dev / ino, which mean nothing on
+            another machine (see import_catalog()).
+        Returns { table: rows written }
+    """
+    db, ds = AppDB.get_db()
+    AppDB.flush_writers()
+
+    counts = { }
+    with gzip.open(out_path, 'wt', compresslevel=compresslevel) as out:
+        out.write(json.dumps({ 'format': FORMAT, 'version': VERSION,
+                               'schema': AppDB.SCHEMA_VERSION, 'host': socket.gethostname(),
+                               'created': time.strftime('%Y-%m-%dT%H:%M:%S%z') }) + '\n')
+
+        with metrics.current().phase('export_files'):
+            rows = db.execute('SELECT %s FROM catalog ORDER BY path, name'
+                              % (', '.join(FILE_COLUMNS)) )
+            counts['files'] = _write_section(out, 'files', FILE_COLUMNS, rows)
+
+        if hashes:
+            with metrics.current().phase('export_hashes'):
+                counts['hash_cache'] = _write_section(out, 'hash_cache', HASH_COLUMNS,
+                                                      AppDB.get_hash_cache().dump())
+
+    metrics.current().count('rows_exported', sum(counts.values()))
+    return counts
+
+def read_catalog(in_path, want):
+    """ Yield (table, row) from an export_catalog() snapshot for the tables in want
+
+        want is { table: columns } - rows come back as tuples in that column order
+    """
+    with gzip.open(in_path, 'rt') as src:
+        header = json.loads(src.readline() or '{}')
+        if header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise ValueError('%s is not a %s v%s snapshot' % (in_path, FORMAT, VERSION))
+
+        table, pick = None, None
+        for line in src:
+            row = json.loads(line)
+            if isinstance(row, dict):
+                table = row['table'] if row['table'] in want else None
+                if table: pick = operator.itemgetter(*[ row['columns'].index(c)
+                                                        for c in want[table] ])
+                continue
+            if table: yield table, pick(row)
+
+def _merge_files(db):
+    ## One statement for the lot - the loaded rows go in (dir, name) order so the
+    ##     files_dir_name index is appended to rather than scattered
+    db.execute('INSERT OR IGNORE INTO dirs (abs_path) SELECT DISTINCT path FROM import_files')
+
+    before = db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    merged = db.execute('''
+        INSERT INTO files (dir_id, name, sha1, hash_algo, fingerprint, status, size)
+        SELECT dirs.id, import_files.name, import_files.sha1, import_files.hash_algo,
+               import_files.fingerprint, import_files.status, import_files.size
+        FROM import_files JOIN dirs ON dirs.abs_path = import_files.path
+        WHERE true ORDER BY dirs.id, import_files.name
+        ON CONFLICT (dir_id, name) DO UPDATE SET
+            sha1 = excluded.sha1, hash_algo = excluded.hash_algo,
+            fingerprint = excluded.fingerprint, status = excluded.status, size = excluded.size
+        WHERE %s > %s''' % (RANK % { 's': 'excluded.status' }, RANK % { 's': 'files.status' }))
+
+    ## rowcount is this statement's inserts + updates - not the meta trigger's (see AppDB)
+    added = db.execute('SELECT COUNT(*) FROM files').fetchone()[0] - before
+    return added, merged.rowcount - added
+
+def import_catalog(in_path, hashes = True, batch_size = 10000):
+    """ Merge an export_catalog() snapshot into this catalog (and hash cache)
+
+        files rows are streamed into a temp table then merged in one statement, all in
+            one transaction. A path we already have only takes the incoming row if its
+            status ranks higher - BLESSED > CURSED > anything else.
+        hash_cache rows are only kept for files that are here with the same size and
+            mtime_ns - and get this machine's dev / ino (see HashCache.merge()).
+        Returns { 'files': rows read, 'added', 'updated', 'kept', 'hash_cache': rows read,
+                  'hashes_added' }
+    """
+    db, ds = AppDB.get_db()
+    AppDB.flush_writers()
+    cache = AppDB.get_hash_cache()
+
+    counts = { 'files': 0, 'hash_cache': 0, 'hashes_added': 0 }
+    insert = 'INSERT INTO import_files (%s) VALUES (%s)' % (', '.join(FILE_COLUMNS),
+                                                           ', '.join( '?' for c in FILE_COLUMNS ))
+    batch, hash_batch = [ ], [ ]
+
+    def load():
+        db.executemany(insert, batch)
+        counts['files'] += len(batch)
+        batch.clear()
+
+    def merge_hashes():
+        counts['hashes_added'] += cache.merge(hash_batch)
+        counts['hash_cache'] += len(hash_batch)
+        hash_batch.clear()
+
+    with db: ## All or nothing - a bad snapshot leaves the catalog as it was
+        db.execute('CREATE TEMP TABLE import_files (%s)' % (', '.join(FILE_COLUMNS)) )
+        try:
+            with metrics.current().phase('import_load'):
+                want = { 'files': FILE_COLUMNS }
+                if hashes: want['hash_cache'] = HASH_COLUMNS
+
+                for table, row in read_catalog(in_path, want):
+                    if table == 'files':
+                        batch.append(row)
+                        if len(batch) >= batch_size: load()
+                    else:
+                        hash_batch.append(row)
+                        if len(hash_batch) >= batch_size: merge_hashes()
+                if batch: load()
+                if hash_batch: merge_hashes()
+
+            with metrics.current().phase('import_merge'):
+                counts['added'], counts['updated'] = _merge_files(db)
+        finally:
+            db.execute('DROP TABLE temp.import_files')
+
+    cache.flush()
+    counts['kept'] = counts['files'] - counts['added'] - counts['updated']
+    metrics.current().count('rows_imported', counts['files'] + counts['hash_cache'])
+
+    g.pop('file_index', None) ## Built from what was there before
+    g.pop('digest_index', None)
+    return counts
@@ -5,22 +5,25 @@ import sqlite3
 import time
 import shutil
 import hashlib
+import functools
+import importlib
+import collections
 from pathlib import Path
  
-import dataset
 import colored
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
 from . import AppDB
-
-def check_file(f):
-    if isinstance(f, str):
-        f = Path(f)
-        return f.is_file() and not f.name.startswith('.') and os.path.getsize(f) > 0
-    else: #already a file object
-        return f.is_file() and not f.name.startswith('.') and os.path.getsize(f) > 0
+from . import hasher
+from . import walker
+from . import dedupe
+from . import fileops
+from . import bench
+from . import metrics
+from . import catalog
+from . import shards
 
 def check_dir(d):
     if isinstance(d, str):
@@ -29,12 +32,183 @@ def check_dir(d):
     else: #already a dir object
         return d.is_dir() and not d.name.startswith('.')
 
+def walk_nodes(path, incremental = False):
+    """ FileNodes for walker.walk(path) - every dir scanned is recorded in `dirs` """
+    dirs = AppDB.DirIndex(load=incremental)
+    reuse = dirs.reuse if incremental else None
+
+    m = metrics.current()
+    for entry in m.timed_iter('walk', walker.walk(path, on_dir=dirs.record, reuse=reuse)):
+        m.count('files_seen')
+        yield AppDB.FileNode(entry)
+
+def incremental_option(f):
+    return click.option('--incremental/--full', default=False,
+                        help='Skip dirs that have not changed since the last scan')(f)
+
+def colliding_sizes(file_list):
+    """ Sizes shared with the DB or another scanned file - only these can be dups """
+    db_sizes = AppDB.known_sizes()
+    counts = collections.Counter( fNode.size for fNode in file_list )
+
+    return set( s for s, n in counts.items() if n > 1 or s in db_sizes )
+
+def colliding_fingerprints(file_list, sizes):
+    """ (size, fingerprint) pairs - of files in `sizes` - that could still be dups """
+    db_fingerprints = AppDB.known_fingerprints()
+    counts = collections.Counter( (fNode.size, fNode.get_fingerprint())
+                                  for fNode in file_list if fNode.size in sizes )
+
+    ## A DB row without a fingerprint (None) could be anything so it collides too
+    return set( k for k, n in counts.items() if n > 1 or 
+                    k[1] in db_fingerprints.get(k[0], ()) or
+                    None in db_fingerprints.get(k[0], ()) )
+
+class RunningScores():
+    """ min / max / mean of the positive (duplicate) scores seen so far - O(1) memory """
+    def __init__(self):
+        self.n, self.mean = 0, 0.0
+        self.min_score, self.max_score = None, None
+
+    def add(self, score):
+        if score <= 0: return
+        self.n += 1
+        self.mean += (score - self.mean) / self.n
+        self.min_score = score if self.min_score is None else min(self.min_score, score)
+        self.max_score = score if self.max_score is None else max(self.max_score, score)
+
+    def thresholds(self, threshold = 0):
+        ave_score = self.mean if threshold <= 0 else threshold
+        return int(ave_score * .8), int(ave_score * 1.2) ## arbitrary - same as `ls`
+
+def ls_echo(fNode, kw):
+    if fNode.score > 0: ## FIXME: Make commandline flag
+        if kw and kw['all']:
+            click.echo('[%5s] %s' % (fNode.score, fNode) )
+        elif not kw['all'] and fNode.status not in ['CURSED', 'NUKE']:
+            ##Default only show ones to save
+            click.echo('[%5s] %s' % (fNode.score, fNode) )
+
+def stream_ls(nodes, kw):
+    """ `ls` without holding the tree - thresholds are estimated as we go
+
+        The first kw['sample'] scored files set the starting thresholds (and are
+        held until then), after that every file is shaded and printed as soon as
+        it's scored and the running mean keeps adjusting the thresholds.
+    """
+    stats, held = RunningScores(), [ ]
+
+    def release(held):
+        lower_T, upper_T = stats.thresholds(kw['threshold'])
+        click.echo("\t[%s [%s - %s] %s]\n" % (stats.min_score or 0, lower_T, upper_T,
+                                               stats.max_score or 0) )
+        for fNode in held:
+            fNode.shade_unique(lower_T, upper_T)
+            ls_echo(fNode, kw)
+
+    for fNode in nodes:
+        fNode.score = fNode.test_unique()
+        stats.add(fNode.score)
+
+        if held is None: ## Warmed up - shade and print right away
+            fNode.shade_unique( *stats.thresholds(kw['threshold']) )
+            ls_echo(fNode, kw)
+            continue
+
+        held.append(fNode)
+        if len(held) >= kw['sample']:
+            release(held)
+            held = None
+
+    if held: release(held) ## Never filled the sample - what we have is the sample
+
+def hash_options(f):
+    """ Add the --jobs / --processes options used to size the hashing pool """
+    f = click.option('--jobs', '-j', default=1, show_default=True,
+                     help='Number of files to hash at the same time')(f)
+    f = click.option('--processes/--threads', default=False,
+                     help='Hash with worker processes instead of threads')(f)
+    return f
+
+def shard_options(f):
+    """ Add --shards - walk / hash / score in worker processes (see shards.scan()) """
+    return click.option('--shards', default=1, show_default=True,
+                        help='Split the tree over this many worker processes')(f)
+
+def check_shards(kw, *conflicts):
+    ## Options that need every file in one place before anything is scored
+    for option in conflicts:
+        if kw['shards'] > 1 and kw[option]:
+            raise click.UsageError('--shards can not be combined with --%s'
+                                   % (option.replace('_', '-')) )
+
+def fingerprint_options(kw):
+    ## Fingerprints are only compared within a size group - --fingerprint needs one
+    if kw['fingerprint']: kw['size_first'] = True
+
+def score_one(fNode):
+    ## A single file - SQL lookups instead of loading the whole catalog (see get_file_index())
+    return fNode.test_unique(file_list=AppDB.get_file_index(preload=False))
+
+def score_nodes(nodes, sizes = None, fingerprints = None):
+    for fNode in nodes:
+        fNode.score = fNode.test_unique(sizes=sizes, fingerprints=fingerprints)
+        yield fNode
+
+def metrics_hook():
+    """ METRICS_HOOK as a callable - it may be given as 'module:function' """
+    hook = current_app.config.get('METRICS_HOOK')
+    if isinstance(hook, str):
+        module, _, name = hook.partition(':')
+        hook = getattr(importlib.import_module(module), name)
+    return hook
+
+def profile_options(f):
+    """ Add --profile / --profile-json / --cprofile and collect metrics for the command
+
+        Goes *under* @with_appcontext so the app config is there when we run.
+        METRICS=True in the config collects for every command, METRICS_HOOK gets
+            each command's metrics.Metrics.summary() dict (e.g. to ship to statsd)
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kw):
+        profile, json_path, phase = kw.pop('profile'), kw.pop('profile_json'), kw.pop('cprofile')
+        hook = metrics_hook()
+        if not (profile or json_path or phase or hook or current_app.config.get('METRICS')):
+            return f(*args, **kw)
+
+        m = metrics.start(click.get_current_context().info_name, phase)
+        try:
+            return f(*args, **kw)
+        finally:
+            AppDB.flush_writers() ## So the last batch of rows is counted too
+            metrics.stop()
+
+            if profile or current_app.config.get('METRICS'):
+                click.echo(m.report(), err=True)
+            if phase:
+                click.echo(m.profile_stats(), err=True)
+            if json_path:
+                with open(json_path, 'w') as afile:
+                    json.dump(m.summary(), afile, indent=2, sort_keys=True)
+            if hook:
+                hook(m.summary())
+
+    wrapper = click.option('--profile/--no-profile', default=False,
+                           help='Print counters and per phase timings when done')(wrapper)
+    wrapper = click.option('--profile-json', default=None, type=click.Path(dir_okay=False),
+                           help='Write the metrics as JSON to this file')(wrapper)
+    wrapper = click.option('--cprofile', default=None, metavar='PHASE',
+                           help='cProfile just this phase (e.g. hash, score, walk)')(wrapper)
+    return wrapper
+
 def close_db_command(e = None):
     """Close the database"""
     AppDB.close_db(e)
 
 @click.command('init-db')
 @with_appcontext
+@profile_options
 def init_db_command():
     """Clear the existing data and create new tables."""
     AppDB.init_db()
@@ -42,6 +216,7 @@ def init_db_command():
 
 @click.command('drop-db')
 @with_appcontext
+@profile_options
 def drop_db_command():
     """Drop the database file, if it exists."""
     AppDB.drop_db()
@@ -52,45 +227,53 @@ def drop_db_command():
 @click.option('--dirs/--no-dirs', default=False)
 @click.option('--hashes/--no-hashes', default=False)
 @with_appcontext
+@profile_options
 def db_ls_command(files = True, dirs = False, hashes = False):
     """List entries in the database."""
     db, ds = AppDB.get_db()
 
     if files:
-        for d in ds['files'].all():
+        for d in ds.query('SELECT * FROM catalog ORDER BY id'):
             Node = AppDB.FileNode(d)
             click.echo('%s' % (Node) )
 
     if dirs:
-        for d in ds['dirs'].all():
+        for d in ds.query('SELECT * FROM dirs ORDER BY id'):
             Node = AppDB.DirNode(d['abs_path'])
             click.echo('%s' % (Node) )
 
-    if hashes:
-        for h in ds['files'].distinct('sha1'):
-            click.echo('%s' % (h['sha1']))
-            for f in ds['files'].find(sha1=h['sha1'], order_by='abs_path'):
-                click.echo('\t[%7s] . %s' % (f['status'], 
-                                            click.format_filename(f['abs_path'])) )
+    if hashes: ## Only sha1s shared by 2+ files - biggest waste first
+        groups, cursor = AppDB.duplicate_groups()
+        while groups:
+            for group in groups:
+                click.echo('%s (%s x %s bytes)' % (group['sha1'], group['count'], group['size']))
+                for f in group['files']:
+                    click.echo('\t[%7s] . %s' % (f['status'], 
+                                                click.format_filename(f['abs_path'])) )
+
+            if not cursor: break
+            groups, cursor = AppDB.duplicate_groups(cursor)
 
 @click.command('db-ls-files')
 @with_appcontext
+@profile_options
 def db_ls_files_command():
     """List files in the database."""
     db, ds = AppDB.get_db()
 
-    for n in ds['files'].all():
+    for n in ds.query('SELECT * FROM catalog ORDER BY id'):
         click.echo('[%7s] %s\n\t%s' % (n['status'], click.format_filename(n['abs_path']), n['sha1']) )
         click.echo('\t%s\n' % click.format_filename(json.dumps(n)) )
     return
 
 @click.command('db-ls-dirs')
 @with_appcontext
+@profile_options
 def db_ls_dirs_command():
     """List dirs in the database."""
     db, ds = AppDB.get_db()
 
-    for n in ds['dirs'].all():
+    for n in ds.query('SELECT * FROM dirs ORDER BY id'):
         click.echo('%s' % click.format_filename(n['abs_path']) )
         click.echo('\t%s\n' % click.format_filename(json.dumps(n)) )
     return
@@ -100,12 +283,13 @@ def db_ls_dirs_command():
                  dir_okay=True, resolve_path=True), required=True)
 @click.command('rm')
 @with_appcontext
+@profile_options
 def db_rm_command(file_name, **kw):
     """ REMOVE file(s) from the database """
 
     if file_name and os.path.isfile(file_name):
         fNode = AppDB.FileNode(file_name)
-        fNode.score = fNode.test_unique() # Checks against DB by default
+        fNode.score = score_one(fNode) # Checks against DB by default
         click.echo('Removing: [%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         fNode.db_delete()
         return
@@ -113,29 +297,26 @@ def db_rm_command(file_name, **kw):
     ## FIXME: file_name could be a different directory THIS WILL IGNORE
     ## Means we passed in '.' and we'll recursively remove all files from DB
     dir_name = os.getcwd()
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue ## Skip directories that don't pass
-
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
-            fNode = AppDB.FileNode( os.path.join(r, f) )
-            fNode.score = fNode.test_unique() # Checks against DB by default
-            click.echo('Removing: [%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
-            fNode.db_delete()
+    for entry in walker.walk(dir_name):
+        fNode = AppDB.FileNode(entry)
+        fNode.score = fNode.test_unique() # Checks against DB by default
+        click.echo('Removing: [%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
+        fNode.db_delete()
      
 @click.argument('file_name', type=click.Path(exists=True, file_okay=True, 
                  dir_okay=False, resolve_path=True), required=False)
 @click.command('curse')
 @with_appcontext
+@profile_options
 def curse_command(file_name = False, **kw):
     """ CURSE the database wih known BAD files """
 
     if file_name:
         fNode = AppDB.FileNode(file_name)
-        fNode.score = fNode.test_unique() # Checks against DB by default
+        fNode.score = score_one(fNode) # Checks against DB by default
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         fNode.set_status("CURSED")
-        fNode.score = fNode.test_unique() # Checks against DB by default
+        fNode.score = score_one(fNode) # Checks against DB by default
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         fNode.db_add()
         return
@@ -143,31 +324,35 @@ def curse_command(file_name = False, **kw):
     dir_name = os.getcwd()
     ## It is possible to store files with the same hash into the DB this way
     ##    that should be ok - but worth noting that DB HASHES may not be unique
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue ## Skip directories that don't pass
-        click.echo('CURSING %s' % click.format_filename(r))
-
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
-            fNode = AppDB.FileNode( os.path.join(r, f) )
-            fNode.set_status("CURSED") ## NOTE: Can overwrite previously BLESSED files
-            fNode.db_add()
+    r = None
+    for entry in walker.walk(dir_name):
+        fNode = AppDB.FileNode(entry)
+        if fNode.path != r:
+            r = fNode.path
+            click.echo('CURSING %s' % click.format_filename(r))
+
+        fNode.set_status("CURSED") ## NOTE: Can overwrite previously BLESSED files
+        fNode.db_add()
 
-            click.echo('\t[%7s] %s' % (fNode.status, fNode) )
+        click.echo('\t[%7s] %s' % (fNode.status, fNode) )
 
 @click.argument('file_name', type=click.Path(exists=True, file_okay=True, 
                  dir_okay=True, resolve_path=True), required=False)
+@incremental_option
+@hash_options
+@shard_options
 @click.command('bless')
 @with_appcontext
+@profile_options
 def bless_command(file_name = False, **kw):
     """ Populate the database wih confirmed files """
 
     if file_name and os.path.isfile(file_name):
         fNode = AppDB.FileNode(file_name)
-        fNode.score = fNode.test_unique()
+        fNode.score = score_one(fNode)
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         fNode.set_status("BLESSED")
-        fNode.score = fNode.test_unique()
+        fNode.score = score_one(fNode)
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         fNode.db_add()
         return
@@ -178,50 +363,86 @@ def bless_command(file_name = False, **kw):
         dir_name = os.getcwd()
     ## It is possible to store files with the same hash into the DB this way
     ##    that should be ok - but worth noting that DB HASHES may not be unique
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue ## Skip directories that don't pass
-        click.echo('Blessing %s' % click.format_filename(r))
+    if kw['shards'] > 1: ## db_add() wants the fingerprint - have the workers read it too
+        nodes = shards.scan(dir_name, kw['shards'], fingerprint=True, jobs=kw['jobs'],
+                            incremental=kw['incremental'])
+    else:
+        nodes = hasher.hash_nodes(walk_nodes(dir_name, kw['incremental']), kw['jobs'],
+                                  kw['processes'], fingerprint=True)
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
-            fNode = AppDB.FileNode( os.path.join(r, f) )
-            fNode.set_status("BLESSED") ## NOTE: Can overwrite previously CURSED files
-            fNode.db_add()
+    r = None
+    for fNode in nodes:
+        if fNode.path != r:
+            r = fNode.path
+            click.echo('Blessing %s' % click.format_filename(r))
 
-            click.echo('\t[%s] %s' % (fNode.status, fNode) )
+        fNode.set_status("BLESSED") ## NOTE: Can overwrite previously CURSED files
+        fNode.db_add()
+
+        click.echo('\t[%s] %s' % (fNode.status, fNode) )
 
 ## Via: https://click.palletsprojects.com/en/7.x/api/#click.Path
 @click.argument('file_name', type=click.Path(exists=True, file_okay=True, 
                    dir_okay=False, resolve_path=True), required=False)
 @click.option('-threshold', '-t', default=0)
 @click.option('--all/--no-all', default=False)
+@click.option('--size-first/--no-size-first', default=False,
+              help='Only hash files whose size matches the DB or another file')
+@click.option('--fingerprint/--no-fingerprint', default=False,
+              help='Compare head / tail fingerprints before hashing (implies --size-first)')
+@click.option('--stream/--no-stream', default=False,
+              help='Print as files are scored - thresholds are estimated online')
+@click.option('--sample', default=1000, show_default=True,
+              help='With --stream how many files to score before printing')
+@hash_options
+@shard_options
 @click.command('ls')
 @with_appcontext
+@profile_options
 def fs_ls_command(file_name = False, **kw): #, show_all_files = False):
     """List files on the filesystem based on database."""
 
     if file_name:
         fNode = AppDB.FileNode(file_name)
-        fNode.score = fNode.test_unique()
+        fNode.score = score_one(fNode)
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         return
 
-    file_list = [ ]
     dir_name = os.getcwd()
+    check_shards(kw, 'stream', 'size_first', 'fingerprint')
+    fingerprint_options(kw)
 
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue ## Skip directories that don't pass
+    if kw['shards'] > 1: ## Hashed and scored by the workers - see shards.scan()
+        file_list = shards.scan(dir_name, kw['shards'], score=True, jobs=kw['jobs'])
+        return ls_shade(file_list, kw)
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue ## Skip files that don't pass
+    if kw['stream']:
+        if kw['size_first']: ## Grouping by size needs the whole walk
+            raise click.UsageError('--stream can not be combined with --size-first'
+                                   ' or --fingerprint')
 
-            fNode = AppDB.FileNode( os.path.join(r, f) )
-            file_list.append(fNode)
+        nodes = walk_nodes(dir_name)
+        return stream_ls(hasher.hash_nodes(nodes, kw['jobs'], kw['processes']), kw)
+
+    file_list = list( walk_nodes(dir_name) )
+
+    sizes, fingerprints, want = None, None, None
+    if kw['size_first']:
+        sizes = colliding_sizes(file_list)
+        want = lambda fNode: fNode.size in sizes
+
+        if kw['fingerprint']:
+            fingerprints = colliding_fingerprints(file_list, sizes)
+            want = lambda fNode: (fNode.size, fNode.fingerprint) in fingerprints
+
+    file_list = list( hasher.hash_nodes(file_list, kw['jobs'], kw['processes'], want) )
 
     ## Running this check vs in previous loop in case we wanted to do something else
-    for fNode in file_list: 
-        fNode.score = fNode.test_unique() # Checks against DB by default
+    file_list = list( score_nodes(file_list, sizes, fingerprints) )
+    ls_shade(file_list, kw)
 
+def ls_shade(file_list, kw):
+    """ Set every (scored) node's status from thresholds over the whole list - then print """
     dup_scores = [n.score for n in file_list if n.score > 0] or [0]
     min_score  = min(dup_scores)
     max_score  = max(dup_scores)
@@ -259,25 +480,42 @@ def fs_ls_command(file_name = False, **kw): #, show_all_files = False):
         else:
             fNode.set_status("NOTSURE")# > 0 but < lower_T - likely name match only
 
-        if fNode.score > 0: ## FIXME: Make commandline flag
-            if kw and kw['all']:
-                click.echo('[%5s] %s' % (fNode.score, fNode) )
-            elif not kw['all'] and fNode.status not in ['CURSED', 'NUKE']:
-                ##Default only show ones to save
-                click.echo('[%5s] %s' % (fNode.score, fNode) )
-             
-
-    """ 
-    ## Possible way to look / check for dups in FS before thinking about db_add()
-    click.echo("")
-    ## In this case the highest score(s) is actually a good thing
-    ##     e.g. store the highest score and you match a lot of the filesystem dups
-    for fNode in file_list:
-        if fNode.score > 0 or "BLESSED" in fNode.status: continue
-        if not "GOOD" in fNode.status: continue ## Another way to filter
-        fNode.score = fNode.test_unique(file_list)
-        click.echo("%5s > %s" % (fNode.score, fNode) )
-    """
+        ls_echo(fNode, kw)
+
+    ## NOTE: Duplicates *within* the scanned tree are `flask dups` (see dedupe.py)
+
+@click.argument('path', type=click.Path(exists=True, file_okay=False,
+                   dir_okay=True, resolve_path=True), required=False)
+@click.option('--all/--no-all', default=False, help='Also list copies only in the DB')
+@hash_options
+@click.command('dups')
+@with_appcontext
+@profile_options
+def fs_dups_command(path = None, **kw):
+    """ List duplicate sets inside a tree - merged with DB matches - and who to keep """
+    if not path: path = os.getcwd()
+
+    groups = dedupe.find_duplicates(walk_nodes(path), jobs=kw['jobs'],
+                                    processes=kw['processes'])
+
+    wasted = 0
+    for group in groups:
+        wasted += group.size * len(group.dups())
+        click.echo('%s (%s x %s bytes)' % (group.sha1, len(group), group.size))
+
+        for fNode in group.files + group.db_files:
+            if fNode is group.keeper:
+                label = 'KEEP'
+            elif fNode in group.files:
+                label = 'DUP'
+            else: ## Only in the DB - nothing to do for it on this tree
+                label = 'DB'
+                if not kw['all']: continue
+
+            click.echo('\t[%4s] [%7s] %s' % (label, fNode.status,
+                                             click.format_filename(fNode.abs_path)) )
+
+    click.echo('%s duplicate sets - %s bytes in copies we could remove' % (len(groups), wasted))
 
 ## FIXME: How does this relate to `flask ls` and scoring?
 
@@ -288,135 +526,490 @@ def fs_ls_command(file_name = False, **kw): #, show_all_files = False):
 @click.option('--blessed/--no-blessed', default=False)
 @click.option('--good/--no-good', default=False)
 @click.option('--nuke/--no-nuke', default=True)
+@click.option('--size-first/--no-size-first', default=False,
+              help='Only hash files whose size matches the DB or another file')
+@click.option('--fingerprint/--no-fingerprint', default=False,
+              help='Compare head / tail fingerprints before hashing (implies --size-first)')
+@incremental_option
+@hash_options
+@shard_options
 @click.command('hunt')
 @with_appcontext
+@profile_options
 def fs_hunt_command(path = None, **kw):
     """ HUNT for files on the filesystem based on BLESSED files in database."""
 
     if path and os.path.isfile(path):
         fNode = AppDB.FileNode(path)
-        fNode.score = fNode.test_unique()
+        fNode.score = score_one(fNode)
         fNode.shade_unique()
         click.echo('[%7s] @ [%5s] %s' % (fNode.status, fNode.score, fNode) )
         return
 
-    db, ds = AppDB.get_db()
-    table = ds['files']
-
     if not path: path = os.getcwd()
+    check_shards(kw, 'size_first', 'fingerprint')
+    fingerprint_options(kw)
+
+    if kw['shards'] > 1: ## Hashed and scored by the workers - see shards.scan()
+        scored = shards.scan(path, kw['shards'], score=True, jobs=kw['jobs'],
+                             incremental=kw['incremental'])
+    else:
+        nodes = walk_nodes(path, kw['incremental'])
+
+        sizes, fingerprints, want = None, None, None
+        if kw['size_first']: ## Needs the full walk up front to group by size
+            nodes = list(nodes)
+            sizes = colliding_sizes(nodes)
+            want = lambda fNode: fNode.size in sizes
 
-    for r, subs, files in os.walk(path):
-        if not check_dir(r): continue ## Skip directories that don't pass
+            if kw['fingerprint']:
+                fingerprints = colliding_fingerprints(nodes, sizes)
+                want = lambda fNode: (fNode.size, fNode.fingerprint) in fingerprints
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue ## Skip some files
+        scored = score_nodes(hasher.hash_nodes(nodes, kw['jobs'], kw['processes'], want),
+                             sizes, fingerprints)
 
-            fNode_fs = AppDB.FileNode( os.path.join(r, f) )
-            fNode_fs.score = fNode_fs.test_unique()
-            fNode_fs.shade_unique()
+    for fNode_fs in scored:
+        fNode_fs.shade_unique()
 
-            ## NOTE: This logic will *NOT* show BLESSED FILES as 'good' - SO DONT just RM DIR!!!
-            if kw['all']:
+        ## NOTE: This logic will *NOT* show BLESSED FILES as 'good' - SO DONT just RM DIR!!!
+        if kw['all']:
+            click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
+        else: ## Want more limited printing
+            if kw['good'] and fNode_fs.status in ['CHECK', 'NOTSURE', 'GOOD', 'unknown']:
                 click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
-            else: ## Want more limited printing
-                if kw['good'] and fNode_fs.status in ['CHECK', 'NOTSURE', 'GOOD', 'unknown']:
-                    click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
-                if kw['nuke'] and fNode_fs.status in ['CURSED', 'NUKE']:
-                    click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
-                if kw['blessed'] and fNode_fs.status in ['BLESSED']:
-                    click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
-
-## FIXME: Placeholder - NEEDS TO BE COMPLETED
+            if kw['nuke'] and fNode_fs.status in ['CURSED', 'NUKE']:
+                click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
+            if kw['blessed'] and fNode_fs.status in ['BLESSED']:
+                click.echo('[%7s] @ [%5s] %s' % (fNode_fs.status, fNode_fs.score, fNode_fs) )
+
+def current_digest(abs_path, st, cache, algo):
+    """ Digest of the file as it is *now* - the cache if its stat still matches, else read it
+
+        Only `verified` rows count - one from the catalog is the very thing we're checking
+    """
+    sha1 = cache.get(st, abs_path, algo, verified=True)
+    if sha1: return sha1
+
+    sha1 = hasher.hash_file(abs_path, algo)
+    cache.put(st, abs_path, sha1, algo)
+    return sha1
+
+def clean_keeper(fNode, st, index, cache, doomed):
+    """ Re-check fNode just before we act on it - (ok, keeper or None, reason)
+
+        CURSED: its content must still be what the DB cursed. NUKE: its content must
+            still be the sha1 we matched and another copy must survive - one that's on
+            disk, the same size (and digest if we know it) and not already queued to go
+    """
+    if st.st_size != fNode.size: return False, None, 'size changed since the scan'
+
+    if fNode.status == 'CURSED':
+        match = index.abs_match(fNode.abs_path)
+        if not match or match.hash_algo != fNode.hash_algo or \
+                current_digest(fNode.abs_path, st, cache, fNode.hash_algo) != match.sha1:
+            return False, None, 'does not match the CURSED DB entry'
+        return True, None, None
+
+    if current_digest(fNode.abs_path, st, cache, fNode.hash_algo) != fNode.sha1:
+        return False, None, 'changed since it was hashed'
+
+    keepers, cursed = [ ], 0
+    for match in index.sha1_match(fNode.sha1, fNode.hash_algo):
+        if match.abs_path == fNode.abs_path or match.abs_path in doomed: continue
+        if "CURSED" in (match.status or ""):
+            cursed += 1
+            continue
+
+        try:
+            m_st = os.stat(match.abs_path)
+        except OSError: ## In the DB but gone from disk - can't count on it
+            continue
+        if m_st.st_size != fNode.size: continue
+
+        try: ## Same size isn't enough - it may have been rewritten in place
+            if current_digest(match.abs_path, m_st, cache, fNode.hash_algo) != fNode.sha1:
+                continue
+        except OSError:
+            continue
+        keepers.append(match)
+
+    if keepers: return True, dedupe.pick_keeper(keepers), None
+    if cursed: return True, None, None ## Only CURSED copies - nothing worth keeping
+    return False, None, 'no other verified copy left'
+
+@click.argument('path', type=click.Path(exists=True, file_okay=False,
+                   dir_okay=True, resolve_path=True), required=False)
+@click.option('--dry-run/--no-dry-run', default=True, show_default=True,
+              help='Only report what would be removed')
+@click.option('--link/--no-link', default=False,
+              help='Replace duplicates with a hardlink to the kept copy instead of deleting')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Files handed to a worker at a time')
+@hash_options
 @click.command('X_clean')
 @with_appcontext
-def fs_clean_command(**kw):
-    """INCOMPLETE - Clean - aka DELETE - files on the filesystem """
-    dir_name = os.getcwd()
-
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue # Skip directories that don't pass
+@profile_options
+def fs_clean_command(path = None, **kw):
+    """ Clean - aka DELETE - CURSED and NUKE files on the filesystem
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
+        Every file is re-verified (size + digest, see clean_keeper()) right before it
+            is queued - anything that changed or has no surviving copy is SKIPPED.
+            Dry run unless --no-dry-run is given.
+    """
+    dir_name = path or os.getcwd()
 
-            abs_src = os.path.join(r, f)
-            fNode = AppDB.FileNode(abs_src)
+    index = AppDB.get_file_index()
+    cache = AppDB.get_hash_cache()
+    cleaner = fileops.Cleaner(max(kw['jobs'], 1), kw['batch_size'], kw['dry_run'], click.echo)
 
-            if not fNode.is_unique():
-                click.echo('NUKE: %s' % (fNode) )
-            else:
-                click.echo('%s' % (fNode) )
+    doomed = set() ## Queued this run - never count these as the surviving copy
+    for fNode in hasher.hash_nodes(walk_nodes(dir_name), kw['jobs'], kw['processes']):
+        fNode.score = fNode.test_unique(file_list=index)
+        fNode.shade_unique()
+        if fNode.status not in ['CURSED', 'NUKE']: continue
 
-## FIXME: Placeholder - NEEDS TO BE COMPLETED
+        try:
+            st = os.stat(fNode.abs_path)
+            ok, keeper, reason = clean_keeper(fNode, st, index, cache, doomed)
+        except OSError as e:
+            ok, keeper, reason = False, None, e
+        if not ok:
+            click.echo('SKIPPED: %s (%s)' % (fNode, reason) )
+            continue
+
+        link_to = None
+        if kw['link'] and keeper is not None:
+            k_st = os.stat(keeper.abs_path)
+            if k_st.st_dev != st.st_dev:
+                click.echo('SKIPPED: %s (kept copy is on another device)' % (fNode) )
+                continue
+            if k_st.st_ino == st.st_ino: continue ## Already the same file
+            link_to = keeper.abs_path
+
+        ## Removing one of several hardlinks frees nothing
+        reclaimed = fNode.size if (link_to or st.st_nlink == 1) else 0
+
+        doomed.add(fNode.abs_path)
+        cleaner.add(fNode.abs_path, reclaimed, link_to)
+
+    cleaner.close()
+    click.echo('%s %s files, %s bytes reclaimed - %s errors' % (
+                    'Would clean' if kw['dry_run'] else 'Cleaned',
+                    cleaner.n_files, cleaner.n_bytes, len(cleaner.errors)) )
+
+@click.argument('path', type=click.Path(exists=True, file_okay=False,
+                   dir_okay=True, resolve_path=True), required=False)
+@click.option('--dst-name', default=None, type=click.Path(file_okay=False))
+@click.option('--dry-run/--no-dry-run', default=False, help='Only list what would be copied')
+@click.option('--verify/--no-verify', default=True, help='Hash each copy against its source')
+@click.option('--reflink/--no-reflink', default=True, help='Try a copy-on-write clone first')
+@hash_options
 @click.command('X_sweep')
-@click.option('--dst-name', default=False)
 @with_appcontext
-def fs_sweep_command(**kw):
-    """ INCOMPLETE - Sweap files on the filesystem """
-    dir_name = os.getcwd()
+@profile_options
+def fs_sweep_command(path = None, **kw):
+    """ Sweep - aka COPY - files not in the DB into DST_DIR_NAME """
+    dir_name = path or os.getcwd()
     if not kw['dst_name']: kw['dst_name'] = current_app.config['DST_DIR_NAME']
+    dst_name = os.path.abspath(kw['dst_name'])
 
+    ## <dst>/<name of the dir we swept>/... - same layout the placeholder printed
     replace_dir, _ = os.path.split(dir_name)
 
-    for r, subs, files in os.walk(dir_name):
-        if not check_dir(r): continue # Skip directories that don't pass
+    index = AppDB.get_file_index()
+    copier = fileops.Copier(max(kw['jobs'], 1), kw['reflink'], kw['verify'], click.echo,
+                            AppDB.get_hash_algo())
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
+    ## Don't sweep our own output if it lives under the tree
+    nodes = ( n for n in walk_nodes(dir_name)
+                  if not (n.abs_path + os.sep).startswith(dst_name + os.sep) )
 
-            abs_src = os.path.join(r, f)
-            fNode = AppDB.FileNode(abs_src)
+    seen = set() ## sha1s already swept this run - one copy of each is enough
+    for fNode in hasher.hash_nodes(nodes, kw['jobs'], kw['processes']):
+        ## Unique means nothing in the DB has this content - BLESSED / CURSED included
+        if fNode.sha1 is None or fNode.sha1 in seen: continue
+        if any( True for match in index.sha1_match(fNode.sha1, fNode.hash_algo) ): continue
+        seen.add(fNode.sha1)
 
-            if fNode.is_unique():
-                click.echo('%s' % (fNode) )
-                new_dst = os.path.join(r, f).replace(replace_dir, kw['dst_name'])
-                click.echo('\t%s' % (new_dst) )
+        new_dst = os.path.join(dst_name, os.path.relpath(fNode.abs_path, replace_dir))
+        if os.path.exists(new_dst): ## An earlier sweep - never overwrite
+            click.echo('EXISTS: %s' % (new_dst) )
+            continue
 
-                ## FIXME: Need to figure out what to do w/ node 
-                ##          - e.g. delete old, make new, store new?
+        if kw['dry_run']:
+            click.echo('%s\n\t%s' % (fNode, new_dst) )
+        else:
+            copier.submit(fNode.abs_path, new_dst, fNode.size, fNode.sha1)
 
-                ## Maybe green means it's not in DB and is new 
-                ##       purple means it is and should be deleted
+    copier.close()
+    n_files, n_bytes, elapsed, rate = copier.throughput()
+    click.echo('Swept %s files, %s bytes in %.1fs (%.1f MB/s) - %s errors' % (
+                    n_files, n_bytes, elapsed, rate / 1e6, len(copier.errors)) )
 
 
 @click.argument('path', type=click.Path(exists=True, file_okay=True, 
                  dir_okay=True, resolve_path=True), required=False)
+@click.option('--evict/--no-evict', default=False,
+              help='Drop cached hashes for files that no longer exist')
+@hash_options
 @click.command('hash_scan')
 @with_appcontext
+@profile_options
 def hash_scan_command(path = False, **kw):
-    """ Populate the database wih confirmed files """
+    """ Populate the hash cache without touching the files table """
     if not path: path = os.getcwd()
 
-    HASH_DB_PATH = 'sqlite:///' + '/Users/wjhuie/bin/instance/cleansweep_hashes.sqlite'
-    click.echo(HASH_DB_PATH)
-
-    db = dataset.connect(HASH_DB_PATH)
-    hash_ds = db['hashes']
-
-    def add_hash(fNode, table = hash_ds):
-        if table.find_one(abs_path=fNode.abs_path): return
+    cache = AppDB.get_hash_cache()
+    click.echo(cache.path)
 
-        fNode.get_hash()
-        entry = { 'abs_path': fNode.abs_path, 'sha1': fNode.sha1 }
-
-        try:
-            table.upsert(entry, ['abs_path'])
+    ## Only what we read goes in - a catalog digest (see needs_hash()) isn't one we saw
+    def add_hash(fNode):
+        if fNode.sha1:
             click.echo('HASH ADDED: %s # %s' % (fNode.sha1, fNode) )
-        except:
+        else:
             click.echo( "Error trying to ADD HASH: %s" % (fNode) )
 
     if path and os.path.isfile(path):
         fNode = AppDB.FileNode(path)
-        add_hash(fNode)
+        if not cache.get(fNode.stat, fNode.abs_path, verified=True):
+            add_hash( next(hasher.hash_nodes([ fNode ], read=True)) )
         return
 
-    for r, subs, files in os.walk(path):
-        if not check_dir(r): continue ## Skip directories that don't pass
+    nodes = ( n for n in walk_nodes(path) if not cache.get(n.stat, n.abs_path, verified=True) )
+
+    for fNode in hasher.hash_nodes(nodes, kw['jobs'], kw['processes'], read=True):
+        add_hash(fNode)
+
+    if kw['evict']:
+        click.echo('EVICTED: %s' % (cache.evict()) )
+
+
+def _under(column, path):
+    ## SQL + args for `column` being path or anything below it - index friendly ranges
+    prefix = os.path.join(path, '')
+    return (' AND (%s = ? OR (%s > ? AND %s < ?))' % (column, column, column),
+            (path, prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+
+def _redigest(items, algo, jobs, processes):
+    ## Read each (abs_path, old algo) once for [ old, new ] digests - None if it can't be
+    return hasher.digest_paths([ (abs_path, [ old_algo, algo ]) for abs_path, old_algo in items ],
+                               jobs, processes)
+
+def migrate_digests(algo, path = None, batch_size = 500, jobs = 1, processes = False,
+                    echo = click.echo, done = None):
+    """ Move files rows (under path, if given) to algo - then hash cache rows the same
+
+        files: each file is read once for both its old and new digest and only moves over
+            if the old one still matches the row - rows for files that are gone or have
+            changed keep their old algorithm (and only match that algorithm).
+        hash cache: rows with no files row to carry them over (e.g. from `hash_scan`) get
+            an algo row of their own if the file is still the one they were taken from.
+        Every batch commits on its own, so an interrupted run just picks up where it
+            left off. done(rows, bytes) is called after each - e.g. job progress / cancel.
+        Returns { 'moved', 'cached', 'read', 'left' }
+    """
+    db, ds = AppDB.get_db()
+    cache = AppDB.get_hash_cache()
+    where, args = _under('path', path) if path else ('', ( ))
+    counts = { 'moved': 0, 'cached': 0, 'read': 0, 'left': 0 }
+
+    statement = ('SELECT id, abs_path, sha1, size, hash_algo FROM catalog'
+                 ' WHERE id > ? AND sha1 IS NOT NULL AND hash_algo IS NOT ?%s'
+                 ' ORDER BY id LIMIT ?' % (where) )
 
-        for f in files:
-            if not check_file( os.path.join(r, f) ): continue
-            fNode = AppDB.FileNode( os.path.join(r, f) )
-            add_hash(fNode)
+    last_id = 0
+    while True:
+        try:
+            rows = db.execute(statement, (last_id, algo) + args + (batch_size, )).fetchall()
+        except sqlite3.OperationalError: ## No files table yet
+            break
+        if not rows: break
+        last_id = rows[-1]['id']
+
+        ## Answer what we can from the cache - only read files it doesn't know
+        todo, reads = [ ], [ ]
+        for row in rows:
+            try:
+                st = os.stat(row['abs_path'])
+            except OSError:
+                counts['left'] += 1
+                continue
+            if st.st_size != row['size']:
+                counts['left'] += 1
+                continue
+
+            old = cache.get(st, row['abs_path'], row['hash_algo'], verified=True)
+            new = cache.get(st, row['abs_path'], algo, verified=True)
+            todo.append( [ row, st, old, new ] )
+            if old is None or new is None: reads.append( todo[-1] )
+
+        ## One read per file gives both the digest to check and the one to write
+        digests = _redigest([ (t[0]['abs_path'], t[0]['hash_algo']) for t in reads ], algo,
+                            jobs, processes)
+        for item, pair in zip(reads, digests):
+            if pair is None: item[2] = item[3] = None
+            else: item[2], item[3] = pair
+        counts['read'] += len(reads)
+
+        updates = [ ]
+        for row, st, old, new in todo:
+            if old != row['sha1'] or new is None:
+                if echo: echo('CHANGED: %s - left on %s' % (row['abs_path'], row['hash_algo']))
+                counts['left'] += 1
+                continue
+
+            cache.put(st, row['abs_path'], old, row['hash_algo'])
+            cache.put(st, row['abs_path'], new, algo)
+            updates.append( (new, algo, row['id']) )
+
+        db.executemany('UPDATE files SET sha1 = ?, hash_algo = ? WHERE id = ?', updates)
+        db.commit()
+        cache.flush()
+        counts['moved'] += len(updates)
+        if echo: echo('... %s rows on %s (%s files read)' % (counts['moved'], algo,
+                                                              counts['read']) )
+        if done: done(len(rows), sum( row['size'] or 0 for row in rows ))
+
+    ## Now the hash cache rows nothing above carried over
+    where, args = _under('h.path', path) if path else ('', ( ))
+    statement = ('SELECT h.rowid, h.dev, h.ino, h.size, h.mtime_ns, h.sha1, h.abs_path, h.algo'
+                 ' FROM hash_cache h WHERE h.rowid > ? AND h.algo IS NOT ?%s AND NOT EXISTS'
+                 ' (SELECT 1 FROM hash_cache n WHERE n.dev = h.dev AND n.ino = h.ino'
+                 ' AND n.algo = ?) ORDER BY h.rowid LIMIT ?' % (where) )
+
+    last_id = 0
+    while True:
+        with cache.lock:
+            rows = cache.db.execute(statement, (last_id, algo) + args +
+                                    (algo, batch_size)).fetchall()
+        if not rows: break
+        last_id = rows[-1][0]
+
+        todo = [ ]
+        for rowid, dev, ino, size, mtime_ns, sha1, abs_path, old_algo in rows:
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) == (dev, ino, size, mtime_ns):
+                todo.append( (st, abs_path, sha1, old_algo) )
+
+        digests = _redigest([ (t[1], t[3]) for t in todo ], algo, jobs, processes)
+        counts['read'] += len(todo)
+        for (st, abs_path, sha1, old_algo), pair in zip(todo, digests):
+            if pair is None or pair[0] != sha1: continue ## Changed since - leave it be
+            cache.put(st, abs_path, pair[0], old_algo)
+            cache.put(st, abs_path, pair[1], algo)
+            counts['cached'] += 1
+
+        cache.flush()
+        if done: done(len(rows), sum( row[3] for row in rows ))
+
+    return counts
+
+@click.argument('path', type=click.Path(exists=True, file_okay=False, dir_okay=True,
+                resolve_path=True), required=False)
+@click.option('--algorithm', '-a', default=None,
+              help='Digest to move the catalog to (default: HASH_ALGORITHM)')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Rows re-digested per transaction')
+@hash_options
+@click.command('migrate-digests')
+@with_appcontext
+@profile_options
+def migrate_digests_command(path = None, **kw):
+    """ Re-digest files rows (under PATH, else all) to another algorithm - see migrate_digests()
+
+        One way: a row only ever matches digests of the algorithm it's on. Until it moves a
+            hunt on the new algorithm sees its file as unknown (and once it moves, a hunt on
+            the old one does) - switch HASH_ALGORITHM when the run is done. For a long run
+            POST /jobs kind=migrate_digests does the same in the background.
+    """
+    try:
+        algo = hasher.check_algorithm(kw['algorithm'] or AppDB.get_hash_algo())
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--algorithm')
+
+    counts = migrate_digests(algo, path, kw['batch_size'], kw['jobs'], kw['processes'])
+    click.echo('Moved %s rows to %s - %s left on their old algorithm' % (counts['moved'],
+                   algo, counts['left']) )
+    click.echo('Hash cache: %s rows without a files row moved too' % (counts['cached']) )
+
+@click.argument('out_file', type=click.Path(dir_okay=False), required=True)
+@click.option('--hashes/--no-hashes', default=True, help='Include the hash cache')
+@click.command('catalog-export')
+@with_appcontext
+@profile_options
+def catalog_export_command(out_file, **kw):
+    """ Write the catalog to a sorted, gzipped snapshot for catalog-import elsewhere """
+    counts = catalog.export_catalog(out_file, kw['hashes'])
+    click.echo('Exported %s files rows, %s hash rows to %s' % (counts['files'],
+                   counts.get('hash_cache', 0), click.format_filename(out_file)) )
+
+@click.argument('in_file', type=click.Path(exists=True, dir_okay=False), required=True)
+@click.option('--hashes/--no-hashes', default=True,
+              help='Merge hash cache rows for files that are here too')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows loaded per statement')
+@click.command('catalog-import')
+@with_appcontext
+@profile_options
+def catalog_import_command(in_file, **kw):
+    """ Merge a catalog-export snapshot - BLESSED > CURSED > other for the same path """
+    try:
+        counts = catalog.import_catalog(in_file, kw['hashes'], kw['batch_size'])
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='IN_FILE')
+
+    click.echo('Imported %s files rows: %s added, %s updated, %s kept as they were'
+               % (counts['files'], counts['added'], counts['updated'], counts['kept']) )
+    if kw['hashes']:
+        click.echo('Hash cache: %s of %s rows added' % (counts['hashes_added'],
+                                                        counts['hash_cache']) )
+
+## Settings from this app worth carrying over into the benchmark's own throw away app
+BENCH_CONFIG = [ 'HASH_ALGORITHM', 'HASH_BLOCK_SIZE', 'HASH_MMAP_MIN', 'HASH_FADVISE',
+                 'DB_BATCH_SIZE', 'DB_SYNCHRONOUS', 'INDEX_MAX_ROWS', 'DIGEST_INDEX' ]
+
+@click.option('--output', '-o', default=None, type=click.Path(dir_okay=False),
+              help='Write the JSON results here instead of stdout')
+@click.option('--root', default=None, type=click.Path(file_okay=False),
+              help='Generate the tree here (and keep it) instead of a temp dir')
+@click.option('--repeat', default=3, show_default=True)
+@click.option('--jobs', '-j', default=1, show_default=True)
+@click.option('--seed', default=bench.TREE_DEFAULTS['seed'], show_default=True)
+@click.option('--dirs', default=bench.TREE_DEFAULTS['dirs'], show_default=True)
+@click.option('--depth', default=bench.TREE_DEFAULTS['depth'], show_default=True)
+@click.option('--files', default=bench.TREE_DEFAULTS['files'], show_default=True,
+              help='Files per dir')
+@click.option('--sizes', default=bench.TREE_DEFAULTS['sizes'], show_default=True,
+              help='fixed:N | uniform:LOW:HIGH | lognormal:MU:SIGMA')
+@click.option('--max-size', default=bench.TREE_DEFAULTS['max_size'], show_default=True)
+@click.option('--dup-ratio', default=bench.TREE_DEFAULTS['dup_ratio'], show_default=True)
+@click.option('--hidden-ratio', default=bench.TREE_DEFAULTS['hidden_ratio'], show_default=True)
+@click.option('--collision-ratio', default=bench.TREE_DEFAULTS['collision_ratio'],
+              show_default=True)
+@click.command('bench')
+@with_appcontext
+@profile_options
+def bench_command(output = None, root = None, repeat = 3, jobs = 1, **tree):
+    """ Time bless / hunt / ls / hash_scan / search on a generated tree - JSON results """
+    try:
+        bench.parse_sizes(tree['sizes'])
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--sizes')
+
+    config = { k: current_app.config[k] for k in BENCH_CONFIG if k in current_app.config }
+    echo = lambda msg: click.echo(msg, err=True) ## Keep stdout for the JSON
 
-    hash_ds.create_index(['abs_path', 'sha1'])
+    results = bench.run_benchmarks(root, max(repeat, 1), jobs, config, echo, **tree)
 
+    for name, r in results['results'].items():
+        echo('%-12s best %8.3fs  median %8.3fs' % (name, r['best'], r['median']) )
+
+    if output:
+        with open(output, 'w') as afile:
+            json.dump(results, afile, indent=2, sort_keys=True)
+    else:
+        click.echo( json.dumps(results, indent=2, sort_keys=True) )
@@ -0,0 +1,74 @@
+import collections
+
+from . import AppDB
+from . import hasher
+
+class DupGroup():
+    """ Files (scanned and in the DB) that share a sha1 - and the one copy to keep """
+    def __init__(self, sha1, size, files, db_files):
+        self.sha1 = sha1
+        self.size = size
+        self.files = files         # FileNodes from the scan
+        self.db_files = db_files   # files table matches that weren't in the scan
+        self.keeper = pick_keeper(files + db_files)
+
+    def __len__(self):
+        return len(self.files) + len(self.db_files)
+
+    def dups(self):
+        """ Scanned files that aren't the keeper - i.e. the ones we could get rid of """
+        return [ fNode for fNode in self.files if fNode.abs_path != self.keeper.abs_path ]
+
+    def wasted(self):
+        return self.size * (len(self) - 1)
+
+def pick_keeper(nodes):
+    """ BLESSED beats everything, CURSED never wins - then the shortest path """
+    def rank(fNode):
+        status = fNode.status or ""
+        return ( 0 if "BLESSED" in status else 2 if "CURSED" in status else 1,
+                 len(fNode.abs_path), fNode.abs_path )
+
+    return min(nodes, key=rank)
+
+def find_duplicates(nodes, index = None, jobs = 1, processes = False):
+    """ Every duplicate set among `nodes` (e.g. cli.walk_nodes()) merged with DB matches
+
+        One pass to group by size - only sizes seen twice in the scan or already in
+        the DB get hashed (see hasher.hash_nodes) - then group those by sha1. Linear
+        in the number of files, no pairwise comparisons.
+
+        Returns [ DupGroup ] most wasted bytes first.
+    """
+    if index is None: index = AppDB.get_file_index()
+
+    by_size = collections.defaultdict(list)
+    for fNode in nodes:
+        by_size[fNode.size].append(fNode)
+
+    db_sizes = AppDB.known_sizes()
+    candidates = [ fNode for size, group in by_size.items()
+                       if len(group) > 1 or size in db_sizes for fNode in group ]
+
+    by_sha1 = collections.defaultdict(list)
+    for fNode in hasher.hash_nodes(candidates, jobs, processes):
+        ## Pick up BLESSED / CURSED for files the DB already knows by path
+        match = index.abs_match(fNode.abs_path)
+        if match and (match.hash_algo, match.sha1) == (fNode.hash_algo, fNode.sha1):
+            fNode.set_status(match.status)
+
+        by_sha1[fNode.sha1].append(fNode)
+
+    groups = [ ]
+    for sha1, files in by_sha1.items():
+        if sha1 is None: continue ## get_hash() couldn't trust the DB row - see needs_hash()
+
+        seen = set( fNode.abs_path for fNode in files )
+        db_files = [ m for m in index.sha1_match(sha1, files[0].hash_algo)
+                         if m.abs_path not in seen ]
+
+        if len(files) + len(db_files) < 2: continue
+        groups.append( DupGroup(sha1, files[0].size, files, db_files) )
+
+    groups.sort(key=lambda group: (-group.wasted(), group.sha1))
+    return groups
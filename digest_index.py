@@ -0,0 +1,204 @@
+import os
+import mmap
+import array
+import bisect
+import struct
+import sqlite3
+import hashlib
+
+from . import metrics
+
+## magic, version, algo, generation, digest width, n digests, n sizes, bloom bits, bloom k
+HEADER = struct.Struct('<8sI32sQIQQQI')
+MAGIC = b'CSDIGIX\0'
+VERSION = 1
+
+BLOOM_BITS = 16 ## Per digest - with BLOOM_K = 4 about 1 in 400 misses gets past the filter
+BLOOM_K = 4
+CHUNK = 65536 ## Sizes per write while building
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _bloom_positions(digest, bits, k = BLOOM_K):
+    ## Digests are already uniformly random - two 64 bit slices of one are all the hashing
+    ##     a double hashed Bloom filter needs
+    digest = digest.ljust(16, b'\0')
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:16], 'little') | 1
+    return [ (h1 + i * h2) % bits for i in range(k) ]
+
+def generation(db):
+    """ files_generation from meta - bumped by every files write (see AppDB._v3_meta) """
+    try:
+        row = db.execute("SELECT value FROM meta WHERE key = 'files_generation'").fetchone()
+    except sqlite3.OperationalError: ## Before the meta migration - or a read only old DB
+        return None
+    return row[0] if row else None
+
+def _write_sizes(out, rows):
+    ## Streamed - in CHUNK sized arrays, never the whole column
+    n, chunk = 0, array.array('Q')
+    for (size, ) in rows:
+        chunk.append(size)
+        if len(chunk) >= CHUNK:
+            out.write(chunk.tobytes())
+            n, chunk = n + len(chunk), array.array('Q')
+    out.write(chunk.tobytes())
+    return n + len(chunk)
+
+def _write_digests(out, rows, width, bloom, bits):
+    ## Rows come in index order - lowercase hex sorts exactly like the bytes it stands for.
+    ##     Anything else could never equal a hexdigest() in SQL either, so it's left out
+    n = 0
+    for (sha1, ) in rows:
+        if sha1 != sha1.lower(): continue
+        try:
+            digest = bytes.fromhex(sha1)
+        except ValueError:
+            continue
+        if len(digest) != width: continue
+
+        out.write(digest)
+        for pos in _bloom_positions(digest, bits):
+            bloom[pos >> 3] |= 1 << (pos & 7)
+        n += 1
+    out.write(b'\0' * (_align(n * width) - n * width))
+    return n
+
+def build(db, path, algo):
+    """ Write the sidecar for the files table - to a temp file swapped in when done
+
+        Sizes and digests stream from their indexes straight into the file - only the
+            Bloom filter (BLOOM_BITS per row) is held in memory. The header goes in last.
+        One read transaction for the generation and the rows so they agree. Readers
+            that already have the old file mapped keep it - the rename doesn't touch it.
+        Returns the generation it was built at
+    """
+    width = hashlib.new(algo).digest_size
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+
+    began = not db.in_transaction
+    if began: db.execute('BEGIN')
+    try:
+        gen = generation(db)
+        ## Rows, not distinct digests, size the filter - an upper bound that costs no sort
+        n_rows = db.execute('SELECT COUNT(*) FROM files WHERE hash_algo = ?'
+                            ' AND sha1 IS NOT NULL', (algo, )).fetchone()[0]
+        bits = _align(max(n_rows * BLOOM_BITS, 64))
+        bloom = bytearray(bits // 8)
+
+        with open(tmp, 'wb') as out:
+            out.write(b'\0' * _align(HEADER.size))
+            n_sizes = _write_sizes(out, db.execute('SELECT DISTINCT size FROM files'
+                                                   ' WHERE size >= 0 ORDER BY size'))
+            n_digests = _write_digests(out, db.execute(
+                                'SELECT DISTINCT sha1 FROM files WHERE hash_algo = ?'
+                                ' AND sha1 IS NOT NULL ORDER BY sha1', (algo, )),
+                                       width, bloom, bits)
+            out.write(bloom)
+
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, VERSION, algo.encode(), gen, width, n_digests,
+                                  n_sizes, bits, BLOOM_K))
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    finally:
+        if began: db.commit()
+
+    os.replace(tmp, path)
+    metrics.current().count('digest_index_builds')
+    return gen
+
+class Sizes():
+    """ The sorted distinct sizes as a read only set - `size in sizes` is a bisect """
+    def __init__(self, view):
+        self.view = view
+
+    def __contains__(self, size):
+        i = bisect.bisect_left(self.view, size)
+        return i < len(self.view) and self.view[i] == size
+
+    def __len__(self):
+        return len(self.view)
+
+    def __iter__(self):
+        return iter(self.view)
+
+class Digests():
+    ## Fixed width digests straight off the mmap - a sequence bisect can search
+    def __init__(self, mm, offset, width, n):
+        self.mm, self.offset, self.width, self.n = mm, offset, width, n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.width
+        return self.mm[start:start + self.width]
+
+class DigestIndex():
+    """ Which digests / sizes the files table has - mapped, never loaded
+
+        Opening it is a header read. Pages come in as lookups touch them and are shared
+            by every process with the file mapped (e.g. shard workers).
+        known_digest() asks the Bloom filter first - most digests hunt sees aren't in the
+            catalog and those never get as far as the sorted array.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as src:
+            self.mm = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mm) < HEADER.size:
+            raise ValueError('%s is not a digest index' % (path) )
+        magic, version, algo, self.generation, self.width, n_digests, n_sizes, \
+            self.bloom_bits, self.bloom_k = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a v%s digest index' % (path, VERSION))
+        self.algo = algo.rstrip(b'\0').decode()
+
+        offset = _align(HEADER.size)
+        self.sizes = Sizes(memoryview(self.mm)[offset:offset + n_sizes * 8].cast('Q'))
+        offset += n_sizes * 8
+        self.digests = Digests(self.mm, offset, self.width, n_digests)
+        self.bloom_offset = offset + _align(n_digests * self.width)
+
+        if self.bloom_offset + self.bloom_bits // 8 > len(self.mm):
+            raise ValueError('%s is truncated' % (path) )
+
+    def known_digest(self, sha1):
+        """ Is hex digest sha1 (in self.algo) in the files table - exact, no false hits """
+        try:
+            digest = bytes.fromhex(sha1)
+        except (TypeError, ValueError):
+            return False
+        if len(digest) != self.width: return False
+
+        for pos in _bloom_positions(digest, self.bloom_bits, self.bloom_k):
+            if not self.mm[self.bloom_offset + (pos >> 3)] & (1 << (pos & 7)):
+                metrics.current().count('bloom_negatives')
+                return False
+
+        i = bisect.bisect_left(self.digests, digest)
+        return i < len(self.digests) and self.digests[i] == digest
+
+def load(db, path, algo, rebuild = True):
+    """ The DigestIndex at path if it's current for db's files table
+
+        Rebuilt first if files changed since (see generation()) - unless rebuild is
+            False (a read only worker) then None, and callers ask SQL instead.
+    """
+    gen = generation(db)
+    if gen is None: return None
+
+    try:
+        index = DigestIndex(path)
+        if index.generation == gen and index.algo == algo: return index
+    except (OSError, ValueError): ## Not built yet - or from some other version
+        pass
+
+    if not rebuild: return None
+    with metrics.current().phase('digest_index_build'):
+        build(db, path, algo)
+    return load(db, path, algo, rebuild=False)
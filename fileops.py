@@ -0,0 +1,194 @@
+import os
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: ## Windows
+    fcntl = None
+
+from . import hasher
+
+FICLONE = 0x40049409 ## linux/fs.h - share extents (btrfs, xfs, ...) instead of copying
+TMP_SUFFIX = '.cleansweep-tmp'
+
+def _reflink(fsrc, fdst):
+    if fcntl is None: return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError: ## Not supported here / across file systems
+        return False
+
+def _copy_range(fsrc, fdst, size):
+    ## Zero-copy inside the kernel - returns how far we got so sendfile can carry on
+    offset = 0
+    if not hasattr(os, 'copy_file_range'): return offset
+
+    try:
+        while offset < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset,
+                                   offset, offset)
+            if n == 0: break
+            offset += n
+    except OSError: ## EXDEV / ENOSYS / EINVAL on older kernels and some file systems
+        pass
+    return offset
+
+def _sendfile(fsrc, fdst, size, offset):
+    if not hasattr(os, 'sendfile'): return offset
+
+    try:
+        while offset < size:
+            n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+            if n == 0: break
+            offset += n
+    except OSError: ## e.g. macOS only sends to sockets
+        pass
+    return offset
+
+def copy_file(src, dst, size, reflink = True):
+    """ Copy src to dst (plus metadata) the cheapest way the kernel lets us
+
+        reflink -> copy_file_range -> sendfile -> shutil (fcopyfile on macOS). The
+        copy lands under a temp name and is renamed into place once complete.
+        Returns the method that did (the last of) the work.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + TMP_SUFFIX
+
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            method, offset = 'reflink', size
+            if not (reflink and _reflink(fsrc, fdst)):
+                method, offset = 'copy_file_range', _copy_range(fsrc, fdst, size)
+            if offset < size:
+                method, offset = 'sendfile', _sendfile(fsrc, fdst, size, offset)
+            if offset < size:
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                method = 'read/write'
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    return method
+
+class Copier():
+    """ Pipelined multi-worker copy - submit() as files are found, results as they land
+
+        verify: re-hash the *copy* (with `algo`) and compare it to the digest we already
+            have for the source - the source is never read twice
+    """
+    def __init__(self, jobs = 4, reflink = True, verify = True, echo = print,
+                 algo = hasher.DEFAULT_ALGORITHM):
+        self.reflink = reflink
+        self.algo = algo
+        self.verify = verify
+        self.echo = echo
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.BoundedSemaphore(jobs * 4) ## Bound what's queued up
+        self.lock = threading.Lock()
+
+        self.started = time.time()
+        self.n_files, self.n_bytes, self.errors = 0, 0, [ ]
+
+    def submit(self, src, dst, size, sha1):
+        self.slots.acquire() ## Back pressure on the walk if the disks can't keep up
+        future = self.pool.submit(self._copy, src, dst, size, sha1)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def _copy(self, src, dst, size, sha1):
+        try:
+            method = copy_file(src, dst, size, self.reflink)
+
+            if self.verify and hasher.hash_file(dst, self.algo) != sha1:
+                os.remove(dst)
+                raise IOError('copy does not match %s %s' % (self.algo, sha1))
+        except Exception as e:
+            with self.lock: self.errors.append( (src, e) )
+            self.echo('FAILED: %s -> %s (%s)' % (src, dst, e))
+            return None
+
+        with self.lock:
+            self.n_files += 1
+            self.n_bytes += size
+        self.echo('[%15s] %s -> %s' % (method, src, dst))
+        return method
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def throughput(self):
+        """ (files, bytes, seconds, bytes / second) so far """
+        elapsed = max(time.time() - self.started, 1e-9)
+        return self.n_files, self.n_bytes, elapsed, self.n_bytes / elapsed
+
+def replace_with_link(target, abs_path):
+    """ Swap abs_path for a hardlink to target - atomically, nothing is lost on failure """
+    tmp = abs_path + TMP_SUFFIX
+    os.link(target, tmp)
+    try:
+        os.replace(tmp, abs_path)
+    except:
+        os.remove(tmp)
+        raise
+
+class Cleaner():
+    """ Batched deletes (or hardlink replacements) run on a worker pool
+
+        Callers verify each file *before* add() - we just act on it. With dry_run
+            nothing is touched but the totals still add up for the report.
+    """
+    def __init__(self, jobs = 4, batch_size = 500, dry_run = True, echo = print):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.echo = echo
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.batch = [ ]
+
+        self.n_files, self.n_bytes, self.errors = 0, 0, [ ]
+
+    def add(self, abs_path, size, link_to = None):
+        self.batch.append( (abs_path, size, link_to) )
+        if len(self.batch) >= self.batch_size: self.flush()
+
+    def flush(self):
+        batch, self.batch = self.batch, [ ]
+        if batch: self.pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        for abs_path, size, link_to in batch:
+            action = 'LINK' if link_to else 'NUKE'
+            try:
+                if self.dry_run:
+                    pass
+                elif link_to:
+                    replace_with_link(link_to, abs_path)
+                else:
+                    os.remove(abs_path)
+            except OSError as e:
+                with self.lock: self.errors.append( (abs_path, e) )
+                self.echo('FAILED: %s %s (%s)' % (action, abs_path, e))
+                continue
+
+            with self.lock:
+                self.n_files += 1
+                self.n_bytes += size
+            self.echo('%s%s: %s%s' % ('WOULD ' if self.dry_run else '', action, abs_path,
+                                     ' => %s' % (link_to) if link_to else ''))
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown(wait=True)
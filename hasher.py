@@ -0,0 +1,220 @@
+import os
+import mmap
+import hashlib
+import itertools
+import threading
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from . import metrics
+
+BLOCKSIZE = 65536
+EDGESIZE = 65536 ## How much of the head and tail of a file goes into its fingerprint
+DEFAULT_ALGORITHM = 'sha1' ## What every row written before HASH_ALGORITHM existed used
+DROP_EVERY = 32 * 1024 * 1024 ## With fadvise, hand back the page cache this often
+
+## How hash_file() reads - block_size bytes at a time into one reused buffer, mmap for
+##     files of at least mmap_min bytes (0 = never) and fadvise to read ahead / not cache
+ReadOptions = collections.namedtuple('ReadOptions', ['block_size', 'mmap_min', 'fadvise'])
+OPTIONS = ReadOptions(BLOCKSIZE, 0, True)
+
+def configure(block_size = BLOCKSIZE, mmap_min = 0, fadvise = True):
+    """ Set the ReadOptions for this process - workers get them from hash_nodes() """
+    global OPTIONS
+    OPTIONS = ReadOptions(int(block_size), int(mmap_min), bool(fadvise))
+    return OPTIONS
+
+def check_algorithm(algo):
+    """ Raise ValueError unless hashlib can give us `algo` with a fixed size digest """
+    try:
+        hashlib.new(algo).hexdigest()
+    except (ValueError, TypeError): ## Unknown or a variable length shake_*
+        raise ValueError('Unsupported HASH_ALGORITHM: %s' % (algo))
+    return algo
+
+def _fadvise(fd, offset, length, advice):
+    ## Only a hint - not every OS / file system has it and that's fine
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (AttributeError, OSError):
+        pass
+
+_BUFFERS = threading.local() ## One read buffer per hashing thread - see _buffer()
+
+def _buffer(block_size):
+    ## Made (and zeroed) once per thread, not per file - small files were paying more
+    ##     for a fresh block_size bytearray than for hashing
+    view = getattr(_BUFFERS, 'view', None)
+    if view is None or len(view) != block_size:
+        view = _BUFFERS.view = memoryview(bytearray(block_size))
+    return view
+
+def _read_into(afile, hashers, opts):
+    ## One buffer for every file on this thread - readinto() on an unbuffered file skips
+    ##     the per-block bytes objects and the extra copy through BufferedReader
+    view = _buffer(opts.block_size)
+    done, dropped = 0, 0
+
+    while True:
+        n = afile.readinto(view)
+        if not n: break
+        for hasher in hashers: hasher.update(view[:n])
+
+        done += n
+        if opts.fadvise and done - dropped >= DROP_EVERY: ## Big files - don't wait till the end
+            _fadvise(afile.fileno(), dropped, done - dropped, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+            dropped = done
+
+def _read_mmap(afile, hashers, opts):
+    with mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'): mm.madvise(mmap.MADV_SEQUENTIAL)
+
+        view = memoryview(mm)
+        try:
+            for offset in range(0, len(mm), opts.block_size):
+                chunk = view[offset:offset + opts.block_size]
+                for hasher in hashers: hasher.update(chunk)
+                chunk.release()
+        finally:
+            view.release() ## mmap won't close while a view is still exported
+
+def hash_file(abs_path, algo = DEFAULT_ALGORITHM, opts = None):
+    """ Return the `algo` hexdigest of the file at abs_path """
+    ## NOTE: Module level (not a FileNode method) so ProcessPoolExecutor can pickle it
+    return hash_file_multi(abs_path, [ algo ], opts)[0]
+
+def hash_file_multi(abs_path, algos, opts = None):
+    """ Return [ hexdigest ] - one per algorithm in `algos` - from a single read
+
+        With opts.fadvise the kernel is told we read front to back (bigger read ahead)
+            and that we won't need the pages again - so hashing a whole disk doesn't
+            push everyone else's working set out of the page cache
+    """
+    if opts is None: opts = OPTIONS
+    hashers = [ hashlib.new(algo) for algo in algos ]
+
+    with open(abs_path, 'rb', buffering=0) as afile:
+        fd = afile.fileno()
+        if opts.fadvise: _fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 2))
+
+        size = os.fstat(fd).st_size
+        if opts.mmap_min and size >= opts.mmap_min:
+            _read_mmap(afile, hashers, opts)
+        else:
+            _read_into(afile, hashers, opts)
+
+        if opts.fadvise: _fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+    return [ hasher.hexdigest() for hasher in hashers ]
+
+def fingerprint_file(abs_path, size = None):
+    """ Return a cheap fingerprint - sha1 of the size plus first and last EDGESIZE bytes
+
+        Two files with different fingerprints can't be the same, equal fingerprints
+        still need a full hash_file() to be sure (unless size <= 2 * EDGESIZE).
+    """
+    if size is None: size = os.path.getsize(abs_path)
+    hasher = hashlib.sha1(b'%d:' % size)
+
+    with open(abs_path, 'rb') as afile:
+        hasher.update( afile.read(EDGESIZE) )
+        if size > EDGESIZE:
+            afile.seek( max(EDGESIZE, size - EDGESIZE) )
+            hasher.update( afile.read(EDGESIZE) )
+    return hasher.hexdigest()
+
+def read_hash(abs_path, algo = DEFAULT_ALGORITHM, opts = None):
+    ## hash_file() for hash_nodes(read=True) - None if the file went away or can't be read
+    try:
+        return hash_file(abs_path, algo, opts)
+    except OSError:
+        return None
+
+def hash_nodes(nodes, jobs = 1, processes = False, want = None, read = False,
+               fingerprint = False):
+    """ Yield FileNodes from `nodes` - in order - with their digest (fNode.sha1) resolved
+
+        Only nodes that `want(fNode)` (default: all) and that can't be answered by
+        the DBs (see FileNode.needs_hash) get read, spread over `jobs` workers.
+        read: skip the DBs and read every node we want - its sha1 stays None if the
+            file can't be read. For callers that must only keep digests they read.
+        fingerprint: resolve fNode.fingerprint too (see FileNode.needs_fingerprint) - in
+            the same workers, e.g. for db_add()
+    """
+    if want is None: want = lambda fNode: True
+
+    if jobs <= 1: ## Serial path - exactly what get_hash() has always done
+        for fNode in nodes:
+            if want(fNode) and read:
+                fNode.sha1 = None
+                try:
+                    fNode.set_hash( fNode.calculate_hash() )
+                except OSError:
+                    pass
+            elif want(fNode):
+                fNode.get_hash()
+            if fingerprint and want(fNode): fNode.get_fingerprint()
+            yield fNode
+        return
+
+    ## Keep a bounded window of nodes in flight so we don't hold the full walk
+    ##    in memory - results are matched back by position so order is stable
+    window = jobs * 64
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    ## Spawned workers never saw configure()
+    read_file = functools.partial(read_hash if read else hash_file, opts=OPTIONS)
+
+    nodes = iter(nodes)
+    with Executor(max_workers=jobs) as pool:
+        while True:
+            batch = list(itertools.islice(nodes, window))
+            if not batch: break
+
+            ## DB lookups stay on this thread - workers only ever read file contents
+            pending = [ n for n in batch if want(n) and (read or n.needs_hash()) ]
+            with metrics.current().phase('hash_batch'):
+                for fNode, sha1 in zip(pending, pool.map(read_file,
+                                                         [ n.abs_path for n in pending ],
+                                                         [ n.hash_algo for n in pending ])):
+                    if sha1: fNode.set_hash(sha1)
+                    else: fNode.sha1 = None
+
+            metrics.current().count('files_hashed', len(pending))
+            metrics.current().count('bytes_hashed', sum( n.size for n in pending ))
+
+            ## After the digests - set_fingerprint() keeps it on their HashCache rows
+            pending = [ n for n in batch if fingerprint and want(n) and n.needs_fingerprint() ]
+            for fNode, fp in zip(pending, pool.map(fingerprint_file,
+                                                   [ n.abs_path for n in pending ],
+                                                   [ n.size for n in pending ])):
+                fNode.set_fingerprint(fp)
+            metrics.current().count('files_fingerprinted', len(pending))
+
+            for fNode in batch:
+                yield fNode
+
+def digest_paths(items, jobs = 1, processes = False):
+    """ For each (abs_path, [ algo ]) in `items` the list of hexdigests - in order
+
+        Every file is read once whatever the number of algorithms - None if it can't be
+    """
+    results = [ ]
+    if jobs <= 1:
+        for abs_path, algos in items:
+            try:
+                results.append( hash_file_multi(abs_path, algos) )
+            except OSError:
+                results.append( None )
+        return results
+
+    Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with Executor(max_workers=jobs) as pool:
+        futures = [ pool.submit(hash_file_multi, abs_path, algos, OPTIONS)
+                        for abs_path, algos in items ]
+
+    for future in futures:
+        try:
+            results.append( future.result() )
+        except OSError:
+            results.append( None )
+    return results
@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from . import cli
+from . import AppDB
+from . import hasher
+from . import metrics
+
+STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+class Cancelled(Exception):
+    pass
+
+class Job():
+    """ One background scan of `path` - what it is, how far it's got and how it ended
+
+        Progress comes from the job's own Metrics (bound to the thread running it - see
+            metrics.bound()) plus files_done / bytes_done as the runner gets through them.
+        Totals aren't known until the walk is done - there's no ETA before then.
+    """
+    def __init__(self, kind, path, options):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.path = path
+        self.options = options
+        self.state = 'queued'
+        self.error = None
+        self.result = None
+
+        self.submitted = time.time()
+        self.started, self.walked, self.finished = None, None, None
+        self.files_total, self.bytes_total = None, None
+        self.files_done, self.bytes_done = 0, 0
+
+        self.metrics = metrics.Metrics('job:%s' % (kind) )
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def check(self):
+        if self.cancelled.is_set(): raise Cancelled()
+
+    def done(self, fNode):
+        """ A runner finished with fNode - and the last chance to notice a cancel """
+        self.files_done += 1
+        self.bytes_done += fNode.size
+        self.check()
+
+    def eta(self, now):
+        ## From the rate since the walk ended - by bytes, or by files for a tree of empties
+        if self.state != 'running' or not self.walked: return None
+        done, total = self.bytes_done, self.bytes_total
+        if not total: done, total = self.files_done, self.files_total
+        if not done: return None
+        return (total - done) * (now - self.walked) / done
+
+    def progress(self):
+        with self.metrics.lock:
+            counters = dict(self.metrics.counters)
+
+        now = self.finished or time.time()
+        elapsed = now - self.started if self.started else 0.0
+        return { 'id': self.id, 'kind': self.kind, 'path': self.path, 'options': self.options,
+                 'state': self.state, 'error': self.error, 'submitted': self.submitted,
+                 'started': self.started, 'finished': self.finished, 'elapsed': elapsed,
+                 'files_seen': counters.get('files_seen', 0),
+                 'files_total': self.files_total, 'files_done': self.files_done,
+                 'bytes_total': self.bytes_total, 'bytes_done': self.bytes_done,
+                 'files_hashed': counters.get('files_hashed', 0),
+                 'bytes_hashed': counters.get('bytes_hashed', 0),
+                 'hash_cache_hits': counters.get('hash_cache_hits', 0),
+                 'files_per_s': self.files_done / elapsed if elapsed else 0.0,
+                 'bytes_per_s': counters.get('bytes_hashed', 0) / elapsed if elapsed else 0.0,
+                 'eta': self.eta(now), 'result': self.result }
+
+def _walk(job):
+    ## The whole walk up front - it's what gives us totals for the ETA
+    nodes = [ ]
+    for fNode in cli.walk_nodes(job.path, job.options['incremental']):
+        job.check()
+        nodes.append(fNode)
+
+    job.files_total, job.bytes_total = len(nodes), sum( fNode.size for fNode in nodes )
+    job.walked = time.time()
+    return nodes
+
+def run_bless(job):
+    for fNode in hasher.hash_nodes(_walk(job), job.options['jobs'], fingerprint=True):
+        fNode.set_status('BLESSED')
+        fNode.db_add()
+        job.done(fNode)
+    return { 'blessed': job.files_done }
+
+def run_hunt(job):
+    statuses, nuke = collections.Counter(), [ ]
+    for fNode in cli.score_nodes(hasher.hash_nodes(_walk(job), job.options['jobs'])):
+        fNode.shade_unique()
+        statuses[str(fNode.status)] += 1
+        if fNode.status in ['CURSED', 'NUKE']: ## What `hunt` prints by default
+            nuke.append({ 'abs_path': fNode.abs_path, 'status': str(fNode.status),
+                          'score': fNode.score })
+        job.done(fNode)
+    return { 'statuses': dict(statuses), 'nuke': nuke }
+
+def run_hash_scan(job):
+    cache = AppDB.get_hash_cache()
+    nodes = [ fNode for fNode in _walk(job)
+                if not cache.get(fNode.stat, fNode.abs_path, verified=True) ]
+    job.files_total, job.bytes_total = len(nodes), sum( fNode.size for fNode in nodes )
+
+    ## read=True - like `hash_scan`, only digests we read go into the HashCache
+    for fNode in hasher.hash_nodes(nodes, job.options['jobs'], read=True):
+        job.done(fNode)
+    return { 'hashed': job.files_done }
+
+def run_migrate_digests(job):
+    ## No walk - totals are the files rows still to move. Hash cache rows come after
+    ##     and aren't counted up front, the totals just grow to take them in
+    algo = AppDB.get_hash_algo()
+    db, ds = AppDB.get_db()
+    where, args = cli._under('path', job.path)
+    try:
+        job.files_total, job.bytes_total = db.execute('SELECT COUNT(*), TOTAL(size) FROM catalog'
+                                                      ' WHERE sha1 IS NOT NULL AND hash_algo'
+                                                      ' IS NOT ?%s' % (where),
+                                                      (algo, ) + args).fetchone()
+    except sqlite3.OperationalError: ## No files table yet
+        job.files_total, job.bytes_total = 0, 0
+    job.bytes_total = int(job.bytes_total)
+    job.walked = time.time()
+
+    def done(n_rows, n_bytes):
+        job.files_done += n_rows
+        job.bytes_done += n_bytes
+        job.files_total = max(job.files_total, job.files_done)
+        job.bytes_total = max(job.bytes_total, job.bytes_done)
+        job.check()
+
+    return cli.migrate_digests(algo, job.path, jobs=job.options['jobs'], echo=None, done=done)
+
+RUNNERS = { 'bless': run_bless, 'hunt': run_hunt, 'hash_scan': run_hash_scan,
+            'migrate_digests': run_migrate_digests }
+
+def parse_options(params):
+    """ What a POST /jobs may set - anything else is ignored """
+    try:
+        jobs = int(params.get('jobs', 1))
+    except (TypeError, ValueError):
+        raise ValueError('jobs must be a number')
+
+    incremental = str(params.get('incremental', '')).lower() in ('1', 'true', 'yes', 'on')
+    return { 'jobs': max(jobs, 1), 'incremental': incremental }
+
+class JobManager():
+    """ Runs Jobs on JOB_WORKERS threads of its own - never on a request's thread
+
+        Jobs past JOB_WORKERS wait their turn in the executor's queue. Each runs in its
+            own app context (so its own DB connection and writers - see get_db()).
+        Cancelling is between files - rows a bless wrote before that stay written.
+        The last JOB_HISTORY finished jobs are kept for GET /jobs.
+    """
+    def __init__(self, app, workers = 2, history = 100):
+        self.app = app
+        self.history = history
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='cleansweep-job')
+        self.jobs = collections.OrderedDict() ## { id: Job } - oldest first
+        self.lock = threading.Lock()
+
+    def submit(self, kind, path, options):
+        if kind not in RUNNERS:
+            raise ValueError('kind must be one of: %s' % (', '.join(sorted(RUNNERS))) )
+
+        job = Job(kind, path, options)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        job.future = self.pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        if job.cancelled.is_set(): return ## Cancelled while it was queued
+
+        job.state, job.started = 'running', time.time()
+        try:
+            with metrics.bound(job.metrics), self.app.app_context():
+                job.result = RUNNERS[job.kind](job)
+            job.state = 'done'
+        except Cancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            self.app.logger.exception('Job %s failed' % (job.id) )
+            job.state, job.error = 'failed', '%s: %s' % (type(e).__name__, e)
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        finished = [ i for i, job in self.jobs.items() if job.finished ]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None: return None
+
+        job.cancelled.set()
+        if job.future.cancel(): ## Never started - it won't now
+            job.state, job.finished = 'cancelled', time.time()
+        return job
+
+_MANAGERS = { } ## { (pid, app): JobManager } - jobs live in the process that took the POST
+_LOCK = threading.Lock()
+
+def get_manager():
+    app = current_app._get_current_object()
+    with _LOCK:
+        key = (os.getpid(), id(app))
+        if key not in _MANAGERS:
+            _MANAGERS[key] = JobManager(app, app.config['JOB_WORKERS'],
+                                        app.config['JOB_HISTORY'])
+        return _MANAGERS[key]
@@ -0,0 +1,171 @@
+import io
+import time
+import functools
+import pstats
+import cProfile
+import threading
+import contextlib
+import collections
+
+class Histogram():
+    """ Timings bucketed by powers of two (in microseconds) - fixed size however many """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = collections.Counter() ## { 2**n us: count } - upper bounds
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.buckets[ 1 << max(int(seconds * 1e6), 1).bit_length() ] += 1
+
+    def quantile(self, q):
+        """ Upper bound (seconds) of the bucket holding the q'th timing """
+        seen, want = 0, q * self.count
+        for bound in sorted(self.buckets):
+            seen += self.buckets[bound]
+            if seen >= want: return min(bound / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return { 'count': self.count, 'total': self.total, 'min': self.min or 0.0,
+                 'max': self.max, 'mean': self.total / self.count if self.count else 0.0,
+                 'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                 'buckets_us': { str(b): n for b, n in sorted(self.buckets.items()) } }
+
+class Metrics():
+    """ Counters plus a timing Histogram per phase for one command
+
+        profile_phase: run cProfile around just that phase (on the thread timing it)
+    """
+    def __init__(self, command = None, profile_phase = None):
+        self.command = command
+        self.started = time.perf_counter()
+        self.counters = collections.Counter()
+        self.phases = collections.defaultdict(Histogram)
+        self.lock = threading.Lock() ## Hash / copy workers count from their own threads
+
+        self.profile_phase = profile_phase
+        self.profiler = cProfile.Profile() if profile_phase else None
+        self.profiling = False
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases[name].add(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profile = name == self.profile_phase and not self.profiling
+        if profile:
+            self.profiling = True
+            self.profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+            if profile:
+                self.profiler.disable()
+                self.profiling = False
+
+    def timed_iter(self, name, iterable):
+        """ Yield from iterable - time spent producing each item is recorded under name """
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        return { 'command': self.command, 'elapsed': time.perf_counter() - self.started,
+                 'counters': dict(self.counters),
+                 'phases': { name: h.summary() for name, h in sorted(self.phases.items()) } }
+
+    def profile_stats(self, limit = 30):
+        if not self.profiler: return ''
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def report(self):
+        """ Human readable summary - see summary() for the same as a dict """
+        summary = self.summary()
+        lines = [ '%s: %.3fs' % (self.command, summary['elapsed']) ]
+
+        for name, n in sorted(summary['counters'].items()):
+            lines.append('  %-20s %12s' % (name, n))
+
+        if summary['phases']:
+            lines.append('  %-20s %9s %10s %10s %10s %10s' % ('phase', 'calls', 'total',
+                                                              'mean', 'p95', 'max'))
+        for name, h in summary['phases'].items():
+            lines.append('  %-20s %9d %9.3fs %9.6fs %9.6fs %9.6fs' % (name, h['count'],
+                             h['total'], h['mean'], h['p95'], h['max']))
+        return '\n'.join(lines)
+
+class NullMetrics():
+    """ What current() hands out when nobody asked - every call is a no-op """
+    def count(self, name, n = 1):
+        pass
+
+    def record(self, name, seconds):
+        pass
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+NULL = NullMetrics()
+_CURRENT = NULL ## Module level, not flask.g - hashing threads have no app context
+_LOCAL = threading.local() ## Per thread override - background jobs (see jobs.py)
+
+def current():
+    return getattr(_LOCAL, 'metrics', None) or _CURRENT
+
+@contextlib.contextmanager
+def bound(metrics):
+    """ current() is metrics on this thread while inside - jobs run side by side """
+    old = getattr(_LOCAL, 'metrics', None)
+    _LOCAL.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _LOCAL.metrics = old
+
+def timed(name):
+    """ Decorator - record every call of the function under phase `name` """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kw):
+            metrics = current()
+            if metrics is NULL: return f(*args, **kw)
+            with metrics.phase(name):
+                return f(*args, **kw)
+        return wrapper
+    return decorator
+
+def start(command = None, profile_phase = None):
+    global _CURRENT
+    _CURRENT = Metrics(command, profile_phase)
+    return _CURRENT
+
+def stop():
+    global _CURRENT
+    metrics, _CURRENT = _CURRENT, NULL
+    return metrics
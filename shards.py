@@ -0,0 +1,176 @@
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+import multiprocessing
+
+from flask import current_app, g
+
+from . import AppDB
+from . import hasher
+from . import walker
+from . import metrics
+
+## Dirs a worker walks before handing the rest of its stack back - small enough that one
+##     huge subtree is soon spread over every worker, big enough to keep IPC cheap
+BUDGET = 64
+
+class ShardCache(AppDB.HashCache):
+    """ The HashCache as a shard worker sees it - a read-only connection of its own
+
+        put()s, set_fingerprint()s (and renames seen by get()) are queued as calls for
+        the coordinator to replay on the real HashCache - it's the only writer (see take()).
+    """
+    def __init__(self, path, algo):
+        self.path = path
+        self.algo = algo
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect('file:%s?mode=ro' % (urllib.parse.quote(path)), uri=True,
+                                  check_same_thread=False)
+        self.calls = [ ] ## [ (method name, args) ] - in the order we made them
+
+    def get(self, st, abs_path = None, algo = None, verified = False):
+        with self.lock:
+            row = self._lookup(st, algo, verified)
+            if not row: return None
+            if abs_path and abs_path != row[1]: ## Renamed / moved - see HashCache.get()
+                self.calls.append( ('put', (st, abs_path, row[0], algo or self.algo,
+                                            bool(row[2]))) )
+            return row[0]
+
+    def put(self, st, abs_path, sha1, algo = None, verified = True):
+        with self.lock:
+            self.calls.append( ('put', (_cached_stat(st), abs_path, sha1, algo or self.algo,
+                                        verified)) )
+
+    def set_fingerprint(self, st, fingerprint):
+        with self.lock:
+            self.calls.append( ('set_fingerprint', (_cached_stat(st), fingerprint)) )
+
+    def take(self):
+        with self.lock:
+            calls, self.calls = self.calls, [ ]
+        return calls
+
+    def flush(self):
+        pass
+
+def _cached_stat(st):
+    ## Picklable - the calls go back to the coordinator
+    return walker.CachedStat(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+_WORKER = { } ## Per worker process: app context, DirIndex, what to do with each file
+
+def _init_worker(config, score, fingerprint, jobs, incremental, collect):
+    from . import create_app
+
+    app = create_app(dict(config, DB_READ_ONLY=True))
+    ctx = app.app_context()
+    ctx.push() ## For the life of the worker - its own read connection (see get_db())
+
+    cache = ShardCache(config['HASH_CACHE'], AppDB.get_hash_algo())
+    AppDB._HASH_CACHES[ (os.getpid(), config['HASH_CACHE'], AppDB.get_hash_algo()) ] = cache
+
+    ## Score through SQL plus the DigestIndex every worker maps (scan() makes it current) -
+    ##     not a copy of the whole catalog per worker
+    g.file_index = AppDB.FileIndex(preload=False)
+
+    dirs = AppDB.DirIndex(load=incremental)
+    _WORKER.update(ctx=ctx, cache=cache, reuse=dirs.reuse if incremental else None,
+                   score=score, fingerprint=fingerprint, jobs=jobs, collect=collect)
+
+def _scan(stack, budget):
+    """ Walk + stat + hash (+ score) from stack - in a worker process
+
+        stack is [ (key, dir_name, dir_st) ] - a key orders a dir's files (0, i) before
+            its sub dirs (1, j) so sorting by key gives exactly walker.walk()'s order.
+        Returns (nodes, dirs, hash cache calls, stack left over, counters) - what's left over
+            once `budget` dirs are done goes back on the queue for any worker to take.
+    """
+    w = _WORKER
+    m = metrics.start('shard') if w['collect'] else None
+
+    stack = list(reversed(stack))
+    nodes, dirs = [ ], [ ]
+    while stack and budget > 0:
+        key, dir_name, dir_st = stack.pop()
+        budget -= 1
+
+        entries, subs, scanned = walker.scan(dir_name, dir_st, w['reuse'])
+        if scanned:
+            dirs.append( (dir_name, dir_st, [ e.path for e in entries ],
+                          [ s for s, st in subs ]) )
+        metrics.current().count('files_seen', len(entries))
+
+        files = [ AppDB.FileNode(entry) for entry in entries ]
+        for i, fNode in enumerate(hasher.hash_nodes(files, w['jobs'])):
+            if w['score']: fNode.score = fNode.test_unique()
+            if w['fingerprint']: fNode.get_fingerprint()
+            nodes.append( (key + (0, i), fNode) )
+
+        subs = [ (key + (1, j), sub, st) for j, (sub, st) in enumerate(subs) ]
+        stack.extend( reversed(subs) ) ## So we pop them in order - like walk()
+
+    counters = dict(metrics.stop().counters) if m else { }
+    return nodes, dirs, w['cache'].take(), stack[::-1], counters
+
+def worker_config():
+    """ This app's config for the workers - they build their own app from it """
+    config = { k: v for k, v in current_app.config.items() if k.isupper() }
+    config.update(METRICS=False, METRICS_HOOK=None) ## Counters come back with each job
+    return config
+
+def scan(top, shards, score = False, fingerprint = False, jobs = 1, incremental = False,
+         budget = BUDGET):
+    """ FileNodes under top - in walker.walk() order - walked by `shards` processes
+
+        Each worker has its own read-only DB and hash cache connections and takes jobs
+            (a stack of dirs) off one shared queue. A job stops after `budget` dirs and
+            the dirs it didn't get to become new jobs, so a skewed tree is split up as
+            it's found rather than left to whichever worker drew the big subtree.
+        This process is the single writer - dirs (see DirIndex.record()) and hash cache
+            rows from every job are written here as results come in.
+        score: test_unique() every file (sets fNode.score), else just hash them -
+            fingerprint: get_fingerprint() too (e.g. for db_add())
+    """
+    ## Not fork - the children would share this process's sqlite handles (and locks)
+    context = multiprocessing.get_context('spawn')
+    collect = metrics.current() is not metrics.NULL
+
+    cache = AppDB.get_hash_cache()
+    cache.flush() ## Workers read it from their own connections
+    AppDB.flush_writers()
+    AppDB.get_digest_index() ## Current before they start - they map it but can't rebuild it
+    record = AppDB.DirIndex().record
+
+    done = queue.Queue()
+    results = [ ]
+    with context.Pool(shards, _init_worker, (worker_config(), score, fingerprint, jobs,
+                                             incremental, collect)) as pool:
+        def submit(stack, n):
+            metrics.current().count('shard_jobs')
+            pool.apply_async(_scan, (stack, n), callback=done.put, error_callback=done.put)
+
+        ## Just `top` first - it comes back with its sub dirs as jobs of their own
+        submit([ ((), top, os.stat(top)) ], 1)
+        running = 1
+
+        while running:
+            result = done.get()
+            running -= 1
+            if isinstance(result, BaseException): raise result
+
+            nodes, dirs, calls, left, counters = result
+            for item in left:
+                submit([ item ], budget)
+                running += 1
+
+            with metrics.current().phase('shard_merge'):
+                results.extend(nodes)
+                for dir_name, dir_st, files, subs in dirs: record(dir_name, dir_st, files, subs)
+                for name, args in calls: getattr(cache, name)(*args)
+                for name, n in counters.items(): metrics.current().count(name, n)
+
+    results.sort(key=lambda item: item[0])
+    return [ fNode for key, fNode in results ]
@@ -0,0 +1,95 @@
+import os
+import stat
+import collections
+
+## Just the parts of os.stat_result we keep around between scans (see HashCache)
+CachedStat = collections.namedtuple('CachedStat', ['st_dev', 'st_ino', 'st_size', 'st_mtime_ns'])
+
+class CachedEntry():
+    """ Stand-in for os.DirEntry when a dir is reused from a previous scan """
+    __slots__ = ('path', 'name', 'sha1', 'fingerprint', '_stat')
+
+    def __init__(self, path, st, sha1 = None, fingerprint = None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.sha1 = sha1
+        self.fingerprint = fingerprint
+        self._stat = st
+
+    def stat(self):
+        return self._stat
+
+def scan(dir_name, dir_st, reuse = None):
+    """ One dir of walk() - ([ entry ], [ (sub_dir, lstat) ], scanned)
+
+        scanned is False if reuse() answered for the dir (or it couldn't be read) - then
+        there's nothing new to record about it. See walk() for the rules and reuse().
+    """
+    cached = reuse(dir_name, dir_st) if reuse else None
+    if cached:
+        files, sub_names = cached
+        files = sorted(files, key=lambda entry: entry.name)
+
+        subs = [ ]
+        for sub in sorted(sub_names):
+            try:
+                st = os.lstat(sub)
+            except OSError: ## Can't happen unless the dir changed under us
+                continue
+            if stat.S_ISDIR(st.st_mode) and st.st_dev == dir_st.st_dev:
+                subs.append( (sub, st) )
+        return files, subs, False
+
+    try:
+        it = os.scandir(dir_name)
+    except OSError: ## Permissions, or it vanished while we were walking
+        return [ ], [ ], False
+
+    files, subs = [ ], [ ]
+    with it:
+        for entry in it:
+            if entry.name.startswith('.'): continue
+
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    ## A different st_dev than our parent means a mount point
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_dev == dir_st.st_dev:
+                        subs.append( (entry.path, st) )
+                elif entry.is_file() and entry.stat().st_size > 0:
+                    files.append(entry)
+            except OSError: ## e.g. dangling symlink
+                continue
+
+    ## By name - a reused dir (see walk()) can't know its scandir order so neither do we
+    files.sort(key=lambda entry: entry.name)
+    subs.sort()
+    return files, subs, True
+
+def walk(top, on_dir = None, reuse = None):
+    """ Yield an os.DirEntry for every file under `top` worth looking at
+
+        Same rules as cli.check_dir() but applied *before* we
+        descend - hidden (`.*`), symlinked and mount-point dirs are never entered,
+        hidden and empty files are skipped. Order is os.walk() top-down but with each
+        dir's files and sub dirs sorted by name - the same whether a dir is reused or not.
+
+        DirEntry caches its stat() so FileNode(entry) costs one syscall per file.
+
+        on_dir(dir_name, st, files, subs) is called for every dir we scandir() and
+        reuse(dir_name, st) may return ([ CachedEntry ], [ sub_dir ]) from a previous
+        scan instead - then only the sub dirs get a stat() (see AppDB.DirIndex)
+    """
+    ## NOTE: `top` itself is always scanned - the user asked for it by name
+    stack = [ (top, os.stat(top)) ]
+
+    while stack:
+        dir_name, dir_st = stack.pop()
+
+        files, subs, scanned = scan(dir_name, dir_st, reuse)
+        for entry in files: yield entry
+
+        if scanned and on_dir:
+            on_dir(dir_name, dir_st, [ e.path for e in files ], [ s for s, st in subs ])
+
+        stack.extend( reversed(subs) ) ## So we pop them in order